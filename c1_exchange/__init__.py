@@ -2,11 +2,19 @@
 import copy
 import logging
 import os
+import time
 from collections import OrderedDict
 from datetime import datetime
+from hashlib import md5
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files import File
+from django.db import connection
+from django.db.models import Case, Value, When
+from django.db.models.functions import Cast
 from django.utils.log import DEFAULT_LOGGING
 from lxml import etree
 from pytils import translit
@@ -27,6 +35,8 @@ C1_IMAGE_POSITION = 'position'
 '''
 log = logging.getLogger('c1_exchange')
 
+KEY_MAPS_CACHE_KEY = 'c1_exchange:key_maps:%s'
+
 
 def append_data(source, target):
     for key, val in source.iteritems():
@@ -73,22 +83,27 @@ def append_logger(conf=DEFAULT_LOGGING, base_dir=None):
 class C1Exchange(object):
     catalog_only_changes = True
     exec_time = None
+    export_page_size = 500
     first_image_delete = True
     image_main = None
+    image_threads = 4
     image_manager = None
     image_position = None
+    key_maps_timeout = 60 * 60
     model_order = None
     model_product = None
     model_property = None
     model_property_value = None
     model_section = None
+    prices_changed = 0
     property_values = []
+    update_batch_size = 500
     verbose = False
     xml_sections = {}
     xml_products = {}
     xml_props = {}
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, session_key=None):
         if hasattr(settings, 'C1_MODELS_ORDER'):
             self.model_order = apps.get_model(*getattr(settings, 'C1_MODELS_ORDER').split('.'))
 
@@ -112,8 +127,114 @@ class C1Exchange(object):
 
         if hasattr(settings, 'C1_IMAGE_POSITION'):
             self.image_position = getattr(settings, 'C1_IMAGE_POSITION')
+        # список на экземпляр, иначе значения свойств копятся в атрибуте класса между обменами
+        self.property_values = []
+        # карты xml_id => pk по меткам моделей загружаются один раз за сессию обмена 1С и дополняются созданными
+        # записями, проходы import.xml и offers.xml сессии получают их из кеша по ключу сессии (см. save_key_maps)
+        self.session_key = session_key
+        self.key_maps = self.load_key_maps()
         self.verbose = verbose
 
+    def add_created_keys(self, model, objects, xml_list):
+        # id созданных объектов возвращает только PostgreSQL, иначе они запрашиваются по xml_id
+        if all(obj.pk is not None for obj in objects):
+            xml_list.update((obj.xml_id, obj.pk) for obj in objects)
+        else:
+            xml_ids = [obj.xml_id for obj in objects]
+            for i in xrange(0, len(xml_ids), self.update_batch_size):
+                xml_list.update((xml, pk) for pk, xml in model.objects.filter(
+                    xml_id__in=xml_ids[i:i + self.update_batch_size]).values_list('pk', 'xml_id'))
+        self.key_maps[model._meta.label] = xml_list
+
+    def bulk_update_field(self, model, field_name, values):
+        field = model._meta.get_field(field_name)
+        pk_list = list(values)
+        batch_size = max(1, min(self.update_batch_size, connection.ops.bulk_batch_size(['pk'] * 3, pk_list)))
+        for i in xrange(0, len(pk_list), batch_size):
+            batch = pk_list[i:i + batch_size]
+            case = Case(*[When(pk=pk, then=Value(values[pk], output_field=field)) for pk in batch], output_field=field)
+            # в PostgreSQL CASE из строковых значений (Decimal передается строкой) иначе имеет тип text
+            if connection.vendor == 'postgresql':
+                case = Cast(case, field)
+            model.objects.filter(pk__in=batch).update(**{field_name: case})
+
+    @staticmethod
+    def clear_key_maps(session_key):
+        # вызывается в начале сессии обмена (catalog_init): xml_id могли измениться между сессиями
+        if session_key:
+            cache.delete(KEY_MAPS_CACHE_KEY % session_key)
+
+    def get_key_map(self, model):
+        if model._meta.label not in self.key_maps:
+            self.key_maps[model._meta.label] = {xml: pk for pk, xml in model.objects.values_list('pk', 'xml_id')}
+        return self.key_maps[model._meta.label]
+
+    def get_order_element(self, order):
+        xml_document = etree.Element(u'Документ')
+        agent_id = unicode(order.user.id) if order.user else u'_%s' % unicode(order.id)
+        delivery_address = [
+            {u'Тип': u'Город', u'Значение': order.city},
+            {u'Тип': u'Улица', u'Значение': order.street},
+            {u'Тип': u'Дом', u'Значение': order.house},
+        ]
+        if order.housing:
+            delivery_address.append({u'Тип': u'Корпус', u'Значение': order.housing})
+        append_data({
+            u'Ид': str(order.id),
+            u'Номер': str(order.id),
+            u'Дата': order.created_at.strftime('%Y-%m-%d'),
+            u'ХозОперация': u'Заказ товара',
+            u'Роль': u'Продавец',
+            # u'Валюта': u'руб',
+            u'Валюта': u'RUB',
+            # u'Курс': '1',
+            u'Курс': '1.0000',
+            u'Сумма': str(order.price),
+            u'Контрагенты': {
+                u'Контрагент': {
+                    u'Ид': agent_id,
+                    u'Наименование': order.email,
+                    u'Роль': u'Покупатель',
+                    u'ПолноеНаименование': order.email,
+                },
+            },
+            u'Время': order.created_at.strftime('%H:%I:%S'),
+            u'Комментарий': order.comment
+        }, xml_document)
+        xml_products = etree.Element(u'Товары')
+        for product in order.products.all():
+            xml_product = etree.Element(u'Товар')
+            append_data({
+                u'Ид': product.xml_id,
+                # u'ИдКаталога': product.xml_id,
+                u'Наименование': product.title,
+                u'ЦенаЗаЕдиницу': str(product.price),
+                u'Количество': str(product.count),
+                u'Сумма': str(product.price_total),
+                u'ЗначенияРеквизитов': {
+                    u'ЗначениеРеквизита': [
+                        {u'Наименование': u'ВидНоменклатуры', u'Значение': u'Товар'},
+                        {u'Наименование': u'ТипНоменклатуры', u'Значение': u'Товар'}]}
+            }, xml_product)
+            xml_product_unit = etree.Element(u'БазоваяЕдиница')
+            xml_product_unit.attrib[u'Код'] = '796'
+            xml_product_unit.attrib[u'НаименованиеПолное'] = u'Штука'
+            xml_product_unit.attrib[u'МеждународноеСокращение'] = 'PCE'
+            xml_product_unit.text = u'шт'
+            xml_product.append(xml_product_unit)
+            xml_products.append(xml_product)
+        xml_document.append(xml_products)
+        append_data({u'ЗначенияРеквизитов': {u'ЗначениеРеквизита': [
+            {u'Наименование': u'Метод оплаты', u'Значение': order.payment},
+            # {u'Наименование': u'Заказ оплачен', u'Значение': u'false'},
+            # {u'Наименование': u'Доставка разрешена', u'Значение': u'false'},
+            # {u'Наименование': u'Отменен', u'Значение': u'false'},
+            # {u'Наименование': u'Финальный статус', u'Значение': u'false'},
+            {u'Наименование': u'Статус заказа', u'Значение': order.status_verbose},
+            # {u'Наименование': u'Дата изменения статуса', u'Значение': },
+        ]}}, xml_document)
+        return xml_document
+
     def import_item_data(self, data_list, xml_list, model, resolve_xml_id=True):
         log.info('import item data for %s' % model.__name__)
         to_insert = []
@@ -121,10 +242,10 @@ class C1Exchange(object):
         for item_data in data_list:
             if not item_data:
                 continue
-            if resolve_xml_id and 'xml_id' in item_data and item_data['xml_id'] in xml_list:
+            # запись из карты сессии могла быть удалена вне обмена, тогда она создается заново
+            if resolve_xml_id and 'xml_id' in item_data and item_data['xml_id'] in xml_list and \
+                    model.objects.filter(pk=xml_list[item_data['xml_id']]).update(**item_data):
                 updated_count += 1
-                model.objects.filter(
-                    pk=xml_list[item_data['xml_id']]).update(**item_data)
             else:
                 to_insert.append(model(**item_data))
         if updated_count > 0:
@@ -133,7 +254,7 @@ class C1Exchange(object):
             model.objects.bulk_create(to_insert)
             log.info('created: %i' % len(to_insert))
             if resolve_xml_id:
-                xml_list = {xml: pk for pk, xml in model.objects.values_list('pk', 'xml_id')}
+                self.add_created_keys(model, to_insert, xml_list)
         return xml_list if resolve_xml_id else None
 
     def import_offers(self, xml_obj):
@@ -141,15 +262,27 @@ class C1Exchange(object):
             return False
         log.info('import offers')
         if not self.xml_products:
-            self.xml_products = {xml: pk for pk, xml in self.model_product.objects.values_list('pk', 'xml_id')}
+            self.xml_products = self.get_key_map(self.model_product)
+        # цены сравниваются со снимком цен из БД, обновляются только изменившиеся
+        price_field = self.model_product._meta.get_field('price')
+        prices = dict(self.model_product.objects.values_list('pk', 'price'))
+        changed = OrderedDict()
+        unchanged_count = 0
         for xml_child in xml_obj.getchildren():
             offer_dict = get_dict_from_lxml(xml_child)
             price = False
             if u'Цены' in offer_dict and u'Цена' in offer_dict[u'Цены']:
                 price = offer_dict[u'Цены'][u'Цена'][u'ЦенаЗаЕдиницу']
             if price and offer_dict[u'Ид'] in self.xml_products:
-                self.model_product.objects.filter(
-                    pk=self.xml_products[offer_dict[u'Ид']]).update(price=price)
+                pk = self.xml_products[offer_dict[u'Ид']]
+                price = price_field.to_python(price)
+                if prices.get(pk) != price:
+                    changed[pk] = prices[pk] = price
+                else:
+                    unchanged_count += 1
+        self.bulk_update_field(self.model_product, 'price', changed)
+        self.prices_changed = len(changed)
+        log.info('prices changed: %i, unchanged: %i' % (len(changed), unchanged_count))
         log.info('import offers time: %s' % (datetime.now() - self.exec_time))
         self.exec_time = datetime.now()
         return True
@@ -160,7 +293,7 @@ class C1Exchange(object):
         log.info('import products')
         data_list = []
         images_dict = {}
-        self.xml_products = {xml: pk for pk, xml in self.model_product.objects.values_list('pk', 'xml_id')}
+        self.xml_products = self.get_key_map(self.model_product)
         for xml_child in xml_obj.getchildren():
             product = get_dict_from_lxml(xml_child)
             item_data = {
@@ -195,7 +328,7 @@ class C1Exchange(object):
             return False
         log.info('import properties')
         data_list = []
-        self.xml_props = {xml: pk for pk, xml in self.model_property.objects.values_list('pk', 'xml_id')}
+        self.xml_props = self.get_key_map(self.model_property)
         for xml_child in xml_obj.getchildren():
             prop = get_dict_from_lxml(xml_child)
             item_data = {
@@ -227,13 +360,7 @@ class C1Exchange(object):
 
             data_list.append(self.prepare_property_value_data(prop_data, prop))
         if self.catalog_only_changes:
-            for value_data in data_list:
-                opts = {'product_id': value_data['product_id'], 'prop_id': value_data['prop_id']}
-                obj = self.model_property_value.objects.filter(**opts).first()
-                if not obj:
-                    obj = self.model_property_value(**opts)
-                obj.value = value_data['value']
-                obj.save()
+            self.upsert_property_values(data_list)
         else:
             self.model_property_value.objects.all().delete()
             self.import_item_data(data_list, [], self.model_property_value, resolve_xml_id=False)
@@ -241,6 +368,33 @@ class C1Exchange(object):
         self.exec_time = datetime.now()
         return True
 
+    def upsert_property_values(self, data_list):
+        # существующие значения товаров загружаются пачками, создаются только новые пары (товар, свойство),
+        # обновляются только изменившиеся значения, из повторов пары в data_list применяется последний
+        model = self.model_property_value
+        existing = {}
+        product_ids = list({value_data['product_id'] for value_data in data_list})
+        for i in xrange(0, len(product_ids), self.update_batch_size):
+            for pk, product_id, prop_id, value in model.objects.filter(
+                    product_id__in=product_ids[i:i + self.update_batch_size]).order_by('pk').values_list(
+                    'pk', 'product_id', 'prop_id', 'value'):
+                existing.setdefault((product_id, prop_id), (pk, value))
+        to_insert = OrderedDict()
+        to_update = OrderedDict()
+        for value_data in data_list:
+            key = (value_data['product_id'], value_data['prop_id'])
+            if key in existing:
+                pk, value = existing[key]
+                if value != value_data['value'] or pk in to_update:
+                    to_update[pk] = value_data['value']
+            elif key in to_insert:
+                to_insert[key].value = value_data['value']
+            else:
+                to_insert[key] = model(product_id=key[0], prop_id=key[1], value=value_data['value'])
+        model.objects.bulk_create(to_insert.values(), batch_size=self.update_batch_size)
+        self.bulk_update_field(model, 'value', to_update)
+        log.info('property values created: %i, updated: %i' % (len(to_insert), len(to_update)))
+
     def import_sections(self, xml_obj):
         if not self.model_section:
             return False
@@ -248,7 +402,7 @@ class C1Exchange(object):
         data_list = []
         groups_list = []
         groups_update_parent = {}
-        self.xml_sections = {xml: pk for pk, xml in self.model_section.objects.values_list('pk', 'xml_id')}
+        self.xml_sections = self.get_key_map(self.model_section)
 
         for pos, third in enumerate(xml_obj.getchildren(), 1):
             groups_list = get_tree_from_lxml(third, u'Группы', u'Ид', {'_position_': pos}, groups_list)
@@ -281,6 +435,31 @@ class C1Exchange(object):
         self.exec_time = datetime.now()
         return True
 
+    def iter_export(self):
+        # заказы выбираются страницами по pk вместе с пользователями и товарами, документ пишется
+        # через etree.xmlfile и отдается частями по мере записи заказов
+        log.info('process export')
+        output = BytesIO()
+        queryset = self.model_order.objects.select_related('user').prefetch_related('products').order_by('pk')
+        with etree.xmlfile(output, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(u'КоммерческаяИнформация', {u'ВерсияСхемы': '2.03', u'ДатаФормирования': '2007-10-30'}):
+                orders = list(queryset[:self.export_page_size])
+                while orders:
+                    for order in orders:
+                        xf.write(self.get_order_element(order), pretty_print=True)
+                    xf.flush()
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate()
+                    orders = list(queryset.filter(pk__gt=orders[-1].pk)[:self.export_page_size])
+        yield output.getvalue()
+
+    def load_key_maps(self):
+        if not self.session_key:
+            return {}
+        return cache.get(KEY_MAPS_CACHE_KEY % self.session_key) or {}
+
     def post_import_products(self, data_list):
         pass
 
@@ -299,77 +478,7 @@ class C1Exchange(object):
     def process_export(self):
         if not self.model_order:
             return False
-        log.info('process export')
-        xml_root = etree.Element(u'КоммерческаяИнформация')
-        xml_root.attrib[u'ВерсияСхемы'] = '2.03'
-        xml_root.attrib[u'ДатаФормирования'] = '2007-10-30'
-        for order in self.model_order.objects.all():
-            xml_document = etree.Element(u'Документ')
-            agent_id = unicode(order.user.id) if order.user else u'_%s' % unicode(order.id)
-            delivery_address = [
-                {u'Тип': u'Город', u'Значение': order.city},
-                {u'Тип': u'Улица', u'Значение': order.street},
-                {u'Тип': u'Дом', u'Значение': order.house},
-            ]
-            if order.housing:
-                delivery_address.append({u'Тип': u'Корпус', u'Значение': order.housing})
-            append_data({
-                u'Ид': str(order.id),
-                u'Номер': str(order.id),
-                u'Дата': order.created_at.strftime('%Y-%m-%d'),
-                u'ХозОперация': u'Заказ товара',
-                u'Роль': u'Продавец',
-                # u'Валюта': u'руб',
-                u'Валюта': u'RUB',
-                # u'Курс': '1',
-                u'Курс': '1.0000',
-                u'Сумма': str(order.price),
-                u'Контрагенты': {
-                    u'Контрагент': {
-                        u'Ид': agent_id,
-                        u'Наименование': order.email,
-                        u'Роль': u'Покупатель',
-                        u'ПолноеНаименование': order.email,
-                    },
-                },
-                u'Время': order.created_at.strftime('%H:%I:%S'),
-                u'Комментарий': order.comment
-            }, xml_document)
-            xml_products = etree.Element(u'Товары')
-            for product in order.products.all():
-                xml_product = etree.Element(u'Товар')
-                append_data({
-                    u'Ид': product.xml_id,
-                    # u'ИдКаталога': product.xml_id,
-                    u'Наименование': product.title,
-                    u'ЦенаЗаЕдиницу': str(product.price),
-                    u'Количество': str(product.count),
-                    u'Сумма': str(product.price_total),
-                    u'ЗначенияРеквизитов': {
-                        u'ЗначениеРеквизита': [
-                            {u'Наименование': u'ВидНоменклатуры', u'Значение': u'Товар'},
-                            {u'Наименование': u'ТипНоменклатуры', u'Значение': u'Товар'}]}
-                }, xml_product)
-                xml_product_unit = etree.Element(u'БазоваяЕдиница')
-                xml_product_unit.attrib[u'Код'] = '796'
-                xml_product_unit.attrib[u'НаименованиеПолное'] = u'Штука'
-                xml_product_unit.attrib[u'МеждународноеСокращение'] = 'PCE'
-                xml_product_unit.text = u'шт'
-                xml_product.append(xml_product_unit)
-                xml_products.append(xml_product)
-            xml_document.append(xml_products)
-            append_data({u'ЗначенияРеквизитов': {u'ЗначениеРеквизита': [
-                {u'Наименование': u'Метод оплаты', u'Значение': order.payment},
-                # {u'Наименование': u'Заказ оплачен', u'Значение': u'false'},
-                # {u'Наименование': u'Доставка разрешена', u'Значение': u'false'},
-                # {u'Наименование': u'Отменен', u'Значение': u'false'},
-                # {u'Наименование': u'Финальный статус', u'Значение': u'false'},
-                {u'Наименование': u'Статус заказа', u'Значение': order.status_verbose},
-                # {u'Наименование': u'Дата изменения статуса', u'Значение': },
-            ]}}, xml_document)
-            xml_root.append(xml_document)
-
-        return etree.tostring(xml_root, encoding='utf-8', pretty_print=True)
+        return b''.join(self.iter_export())
 
     def process_import(self, file_path):
         start_time = datetime.now()
@@ -403,27 +512,106 @@ class C1Exchange(object):
                         # offers
                         if remove_xml_namespace(second.tag) == u'Предложения':
                             self.import_offers(second)
+        self.save_key_maps()
         log.info('total import time: %s' % (datetime.now() - start_time))
 
+    def save_key_maps(self):
+        # сохраняются только после успешного импорта файла, иначе следующий проход загрузит карты из БД заново
+        if self.session_key:
+            cache.set(KEY_MAPS_CACHE_KEY % self.session_key, self.key_maps, self.key_maps_timeout)
+
+    def get_file_hash(self, f):
+        file_hash = md5()
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def get_stored_hash(self, image, size):
+        # отсутствующий или нечитаемый файл хранилища, как и файл другого размера, считается измененным
+        try:
+            if image.file.size != size:
+                return None
+            with image.file.storage.open(image.file.name, 'rb') as f:
+                return self.get_file_hash(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def prepare_image(self, task):
+        # выполняется в потоке: файл, совпадающий с уже сохраненным изображением товара, пропускается,
+        # иначе копируется в хранилище, а запись изображения сохраняется в основном потоке
+        product, image_path, stored_images = task
+        path = os.path.join(settings.MEDIA_ROOT, '1c_exchange', image_path)
+        try:
+            with open(path, 'rb') as f:
+                file_hash = self.get_file_hash(f)
+                size = os.fstat(f.fileno()).st_size
+                for image in stored_images:
+                    if image.file and self.get_stored_hash(image, size) == file_hash:
+                        return product, image, None
+                f.seek(0)
+                data = {'file': File(f)}
+                if self.image_position:
+                    data[self.image_position] = 1
+                related_field = getattr(self.model_product, self.image_manager).field
+                img = related_field.model(**data)
+                setattr(img, related_field.name, product)
+                img._meta.get_field('file').pre_save(img, True)
+            return product, None, img
+        except (IOError, OSError), e:
+            return product, None, e
+
     def process_images(self, images_dict):
         if not self.image_manager:
             return False
         log.info('process images')
-        for xml_id, image_path in images_dict.iteritems():
-            path = os.path.join(settings.MEDIA_ROOT, '1c_exchange', image_path)
-            try:
-                data = {'file': File(open(path))}
-                product = self.model_product.objects.get(pk=self.xml_products[xml_id])
-                images = getattr(product, self.image_manager)
-                if self.first_image_delete and self.image_position:
-                    images.filter(**{self.image_position: 1}).delete()
+        start_time = time.time()
+        stats = {'saved': 0, 'skipped': 0, 'errors': 0}
+        items = images_dict.items()
+        related_field = getattr(self.model_product, self.image_manager).field
+        image_model = related_field.model
+        pool = ThreadPool(self.image_threads)
+        try:
+            for i in xrange(0, len(items), self.update_batch_size):
+                batch = items[i:i + self.update_batch_size]
+                products = self.model_product.objects.in_bulk([self.xml_products[xml_id] for xml_id, _ in batch])
+                stored = {}
+                filters = {'%s__in' % related_field.name: list(products)}
                 if self.image_position:
-                    data[self.image_position] = 1
-                img = images.create(**data)
-                if self.image_main:
-                    setattr(product, self.image_main, img.file)
-                    product.save()
-            except IOError, e:
-                log.info(str(e))
+                    filters[self.image_position] = 1
+                for image in image_model.objects.filter(**filters).order_by('pk'):
+                    stored.setdefault(getattr(image, related_field.attname), []).append(image)
+                tasks = [(products[self.xml_products[xml_id]], image_path, stored.get(self.xml_products[xml_id], []))
+                         for xml_id, image_path in batch]
+
+                created, delete_list = [], []
+                for product, image, img in pool.imap(self.prepare_image, tasks):
+                    if isinstance(img, Exception):
+                        log.info(str(img))
+                        stats['errors'] += 1
+                    elif img is None:
+                        stats['skipped'] += 1
+                        if self.image_main and getattr(product, self.image_main).name != image.file.name:
+                            setattr(product, self.image_main, image.file)
+                            product.save(update_fields=[self.image_main])
+                    else:
+                        created.append((product, img))
+                        if self.first_image_delete and self.image_position:
+                            delete_list += [stored_image.pk for stored_image in stored.get(product.pk, [])]
+
+                # заменяемые изображения удаляются одним запросом до сохранения новых
+                if delete_list:
+                    image_model.objects.filter(pk__in=delete_list).delete()
+                for product, img in created:
+                    img.save()
+                    if self.image_main:
+                        setattr(product, self.image_main, img.file)
+                        product.save(update_fields=[self.image_main])
+                stats['saved'] += len(created)
+        finally:
+            pool.close()
+            pool.join()
+        exec_seconds = time.time() - start_time
+        log.info('images saved: %(saved)i, skipped: %(skipped)i, errors: %(errors)i' % stats)
+        log.info('process images: %.1f images/s' % (len(items) / exec_seconds if exec_seconds else 0))
         log.info('process images time: %s' % (datetime.now() - self.exec_time))
         self.exec_time = datetime.now()
@@ -7,6 +7,7 @@ import zipfile
 from django.contrib import auth
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 
@@ -40,6 +41,8 @@ def catalog_checkauth(request):
 
 
 def catalog_init(request):
+    c1m = importlib.import_module(c1_exchange_module)
+    c1m.C1Exchange.clear_key_maps(request.session.session_key)
     if os.path.exists(upload_dir):
         shutil.rmtree(upload_dir)
     os.makedirs(upload_dir)
@@ -98,7 +101,7 @@ def catalog_import(request):
         return HttpResponseBadRequest('failure\n''bad filename')
 
     c1m = importlib.import_module(c1_exchange_module)
-    exchange = c1m.C1Exchange()
+    exchange = c1m.C1Exchange(session_key=request.session.session_key)
     exchange.process_import(os.path.join(upload_dir, filename))
     log.info('import mode success')
     return HttpResponse('success\nfile imported')
@@ -134,8 +137,9 @@ def sale_init(request):
 def sale_query(request):
     c1m = importlib.import_module(c1_exchange_module)
     exchange = c1m.C1Exchange()
-    xml_data = exchange.process_export()
-    return HttpResponse(xml_data, content_type='application/xml')
+    if not exchange.model_order:
+        return HttpResponse(exchange.process_export(), content_type='application/xml')
+    return StreamingHttpResponse(exchange.iter_export(), content_type='application/xml')
 
 
 def sale_success(request):
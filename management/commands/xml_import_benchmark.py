@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import importlib
+import os
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from ...xml_import import ImportXML
+from ...xml_import.benchmark import DEFAULT_SIZES, compare_results, load_baseline, run_benchmark, save_baseline
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks ImportXML on generated xml for settings.IMPORTXML_DATA_MAP in a SQLite test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sizes', nargs='*', type=int, default=list(DEFAULT_SIZES))
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--revisions', type=int, default=2)
+        parser.add_argument('--files', action='store_true', help='fill files attributes (files are saved to storage)')
+        parser.add_argument('--import-class', help='dotted path to ImportXML subclass')
+        parser.add_argument('--baseline', help='json file with baseline results to compare against, '
+                                               'see xml_import/benchmark_baseline.json')
+        parser.add_argument('--save', action='store_true', help='save results as baseline')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('benchmark runs on SQLite only, use settings with a SQLite default database')
+        import_class = ImportXML
+        if options['import_class']:
+            module_name, class_name = options['import_class'].rsplit('.', 1)
+            import_class = getattr(importlib.import_module(module_name), class_name)
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = run_benchmark(options['sizes'], options['seed'], options['revisions'], import_class,
+                                    options['files'], self.stdout.write)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for size, size_results in sorted(results.items(), key=lambda x: int(x[0])):
+            for revision, result in sorted(size_results.items()):
+                self.stdout.write('%s items, revision %s:' % (size, revision))
+                for stage, metrics in result['stages'].items():
+                    self.stdout.write('  %-16s %8.2fs %10i rows %8i queries %8.1f MB peak' % (
+                        stage, metrics['time'], metrics['rows'], metrics['queries'], metrics['peak_rss'] / 1048576.0))
+
+        if options['baseline'] and os.path.exists(options['baseline']):
+            self.stdout.write('compared to baseline %s:' % options['baseline'])
+            for size, revision, key, base, current, ratio in compare_results(results, load_baseline(options['baseline'])):
+                self.stdout.write('  %s/%s %-24s %14.2f %14.2f %7.2fx' % (size, revision, key, base, current, ratio))
+        if options['save']:
+            if not options['baseline']:
+                raise CommandError('--save requires --baseline')
+            save_baseline(options['baseline'], results)
+            self.stdout.write('baseline saved to %s' % options['baseline'])
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import time
+from django.core.management import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Runs queued xml_import jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+        parser.add_argument('--sleep', type=float, default=5, help='seconds to wait for new jobs')
+        parser.add_argument('--recover', action='store_true', help='requeue jobs of stopped workers')
+        parser.add_argument('--retry-failed', nargs='*', type=int, metavar='JOB_ID',
+                            help='requeue failed jobs (all if no ids given), they resume from their checkpoints')
+
+    def handle(self, *args, **options):
+        from ...xml_import.jobs import claim_next, recover_running, retry_failed, run_job
+        if options['recover']:
+            self.stdout.write('requeued %i jobs' % recover_running())
+        if options['retry_failed'] is not None:
+            self.stdout.write('requeued %i failed jobs' % retry_failed(options['retry_failed'] or None))
+        while True:
+            job = claim_next()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write('job %s started' % job.pk)
+            job = run_job(job)
+            self.stdout.write('job %s %s' % (job.pk, job.status))
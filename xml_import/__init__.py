@@ -4,21 +4,81 @@ from django.apps import apps
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
-from django.core.exceptions import ImproperlyConfigured
-from django.db import transaction
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Case, Max, Value, When
+from django.db.models.functions import Cast
+from django.db.backends.utils import truncate_name
+from django.db.models.signals import post_delete, pre_delete
 from django.utils.dateparse import parse_datetime
 from django.utils import timezone
 from lxml import etree
+from itertools import izip
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
-from os import path, makedirs, rename
-from shutil import rmtree
+from functools import partial
+from hashlib import md5
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+from os import path, makedirs, remove, rename, stat
+from shutil import copyfileobj, rmtree
+from tempfile import mkdtemp
+import json
 import logging
+import sqlite3
+import time
 import zipfile
+from .. import chunks
+from .cache_versions import get_key_index_version, get_label, invalidate_key_indexes, invalidate_models
+from .locks import lock_models
+from .metrics import ImportSummary, QueryCounter, get_peak_rss, get_rss, reset_peak_rss
+from .signals import import_done, records_changed, stage_done
+from .spool import SpoolIndex, Spooler, iter_batches
 
 log = logging.getLogger(__name__)
 tz = timezone.utc
 
 
+class Missing(object):
+    """Значение поля записи, отсутствующего в xml"""
+    def __reduce__(self):
+        return str('MISSING')
+
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = Missing()
+
+key_indexes = {}
+"""dict: снимки индексов между запусками ImportXML: (метка модели, id_field) => (версия, максимальный id, key_map)"""
+
+shard_import_xml = None
+"""ImportXML: экземпляр, разбирающий части xml в дочерних процессах, наследуется ими при fork"""
+
+
+def parse_shard(shard):
+    """
+    Разбирает часть дочерних элементов корня xml в дочернем процессе, см. ImportXML.parse_parallel
+
+    Args:
+        shard (str): сериализованные дочерние элементы корня, обернутые в элемент Shard
+
+    Returns:
+        tuple: записи и очереди ImportXML.shard_queues, собранные при разборе
+    """
+    import_xml = shard_import_xml
+    for name in import_xml.shard_queues:
+        setattr(import_xml, name, {})
+    import_xml.interned = {}
+    import_xml.spooler = None
+    data_list = []
+    for item in etree.fromstring(shard).iterchildren():
+        import_xml.process_item(item, data_list)
+    return (data_list,) + tuple(getattr(import_xml, name) for name in import_xml.shard_queues)
+
+
 class ElementWrapper(object):
     xml = None
     data_name = None
@@ -28,6 +88,178 @@ class ElementWrapper(object):
         self.data_name = data_name
 
 
+class DataBlock(object):
+    """Скомпилированный data_block схемы: кортежи атрибутов с привязанными функциями очистки"""
+    attributes = ()
+    """tuple: (xml атрибут, поле модели, функция очистки или None)"""
+    text = None
+    """str: поле модели для текста элемента"""
+    foreign_keys = ()
+    """tuple: (xml атрибут, поле модели, data_name связанной модели)"""
+    files = ()
+    """tuple: (xml атрибут, поле модели)"""
+
+    def __init__(self, import_xml, data_name, data_map, model):
+        """
+        Args:
+            import_xml (ImportXML): импорт, методы которого используются как функции очистки
+            data_name (str): ключ ImportXML.data_map для сообщений об ошибках
+            data_map (dict): data_block из ImportXML.data_map
+            model (django.db.models.Model): модель, поля которой проверяются
+        """
+        clean_fields = data_map.get('clean_fields', {})
+        attributes = []
+        for xml_key, model_property in data_map.get('attributes', {}).items():
+            func = clean_fields.get(model_property)
+            if isinstance(func, (str, unicode)):
+                if not hasattr(import_xml, func):
+                    raise ImproperlyConfigured('%s: отсуствует функция очистки %s' % (data_name, func))
+                func = getattr(import_xml, func)
+            attributes.append((xml_key, self.check_field(data_name, model, model_property), func))
+        self.attributes = tuple(attributes)
+
+        if 'text' in data_map:
+            self.text = self.check_field(data_name, model, data_map['text'])
+
+        foreign_keys = []
+        for xml_key, (model_property, target_data_name) in data_map.get('foreign_keys', {}).items():
+            if target_data_name not in import_xml.data_map:
+                raise ImproperlyConfigured('%s: отсуствует %s в ImportXML.data_map' % (data_name, target_data_name))
+            foreign_keys.append((xml_key, self.check_field(data_name, model, model_property), target_data_name))
+        self.foreign_keys = tuple(foreign_keys)
+
+        self.files = tuple((xml_key, self.check_field(data_name, model, model_property))
+                           for xml_key, model_property in data_map.get('files', {}).items())
+
+    @staticmethod
+    def check_field(data_name, model, model_property):
+        """Возвращает model_property, если такое поле есть у модели, иначе вызывает ImproperlyConfigured"""
+        try:
+            model._meta.get_field(model_property)
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured('%s: у модели %s нет поля %s' % (data_name, model.__name__, model_property))
+        return model_property
+
+
+class DataHandler(DataBlock):
+    """Скомпилированная схема data_name из ImportXML.data_map"""
+    data_name = None
+    model = None
+    """django.db.models.Model: модель, загруженная из apps"""
+    children_fields = None
+    """dict: xml тег дочернего элемента => DataBlock с полями этой же записи"""
+    children = None
+    """dict: xml тег дочернего элемента => DataHandler дочерней модели"""
+    children_key_field = None
+    without_id = False
+    delete_by_field = None
+    post_save_callback = False
+    """bool: есть ли у модели post_save_callback"""
+    columns = ()
+    """tuple: поля модели, заполняемые из xml, в порядке их хранения в кортеже записи"""
+    fk_targets = None
+    """dict: поле модели внешнего ключа => data_name связанной модели"""
+
+    def __init__(self, import_xml, data_name, data_map):
+        if 'model' not in data_map:
+            raise ImproperlyConfigured('%s: отсуствует model' % data_name)
+        try:
+            model = apps.get_model(*data_map['model'].split('.'))
+        except (LookupError, TypeError, ValueError):
+            raise ImproperlyConfigured('%s: модель %s не найдена' % (data_name, data_map['model']))
+        super(DataHandler, self).__init__(import_xml, data_name, data_map, model)
+        self.data_name = data_name
+        self.model = model
+        self.children_fields = {tag: DataBlock(import_xml, data_name, block, model)
+                                for tag, block in data_map.get('children_fields', {}).items()}
+        self.children = {}
+        if 'children_key_field' in data_map:
+            self.children_key_field = data_map['children_key_field']
+        self.without_id = 'without_id' in data_map
+        if 'delete_by_field' in data_map:
+            self.delete_by_field = self.check_field(data_name, model, data_map['delete_by_field'])
+        self.post_save_callback = hasattr(model, 'post_save_callback')
+        self.fk_targets = {}
+        columns = set()
+        for block in [self] + list(self.children_fields.values()):
+            columns.update(model_property for xml_key, model_property, func in block.attributes)
+            if block.text:
+                columns.add(block.text)
+            for xml_key, model_property, target_data_name in block.foreign_keys:
+                self.add_foreign_key(model_property, target_data_name)
+        self.columns = tuple(sorted(columns | set(self.fk_targets)))
+
+    def add_foreign_key(self, model_property, target_data_name):
+        """Добавляет колонку внешнего ключа, проверяя, что поле всегда ссылается на один data_name"""
+        if self.fk_targets.get(model_property, target_data_name) != target_data_name:
+            raise ImproperlyConfigured('%s: поле %s ссылается на разные data_name' % (self.data_name, model_property))
+        self.fk_targets[model_property] = target_data_name
+        if model_property not in self.columns:
+            self.columns = tuple(sorted(self.columns + (model_property,)))
+
+    def pack(self, item_data):
+        """
+        Упаковывает item_data в кортеж записи (data_name, xml_id, значения DataHandler.columns),
+        внешние ключи хранятся как xml_id, отсутствующие поля – как MISSING
+        """
+        fields, foreign_keys = item_data['fields'], item_data['foreign_keys']
+        row = [self.data_name, item_data['xml_id']]
+        for column in self.columns:
+            if column in foreign_keys:
+                row.append(foreign_keys[column][0])
+            else:
+                row.append(fields.get(column, MISSING))
+        return tuple(row)
+
+    def unpack(self, row):
+        """Распаковывает кортеж записи в словарь item_data, как его создает ImportXML.process_item"""
+        fields, foreign_keys = {}, {}
+        for column, value in izip(self.columns, row[2:]):
+            if value is MISSING:
+                continue
+            if column in self.fk_targets:
+                foreign_keys[column] = (value, self.fk_targets[column])
+            else:
+                fields[column] = value
+        return {'data_name': row[0], 'xml_id': row[1], 'fields': fields, 'foreign_keys': foreign_keys}
+
+
+class FingerprintStore(object):
+    """Хранилище отпечатков записей (data_name, xml_id) => md5 в отдельном sqlite файле"""
+    batch_size = 500
+
+    def __init__(self, file_path):
+        self.db = sqlite3.connect(file_path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprint '
+            '(data_name TEXT, xml_id TEXT, fingerprint TEXT, PRIMARY KEY (data_name, xml_id))')
+
+    def clear(self, data_name):
+        with self.db:
+            self.db.execute('DELETE FROM fingerprint WHERE data_name = ?', (data_name,))
+
+    def delete_many(self, data_name, xml_ids):
+        with self.db:
+            for batch in chunks(list(xml_ids), self.batch_size):
+                self.db.execute('DELETE FROM fingerprint WHERE data_name = ? AND xml_id IN (%s)' % ', '.join(
+                    '?' * len(batch)), [data_name] + batch)
+
+    def get_many(self, data_name, xml_ids):
+        """Возвращает словарь xml_id => отпечаток для сохраненных записей"""
+        result = {}
+        for batch in chunks(list(xml_ids), self.batch_size):
+            result.update(self.db.execute(
+                'SELECT xml_id, fingerprint FROM fingerprint WHERE data_name = ? AND xml_id IN (%s)' % ', '.join(
+                    '?' * len(batch)), [data_name] + batch))
+        return result
+
+    def set_many(self, data_name, fingerprints):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO fingerprint (data_name, xml_id, fingerprint) VALUES (?, ?, ?)',
+                ((data_name, xml_id, fingerprint) for xml_id, fingerprint in fingerprints.items()))
+
+
 class ImportXML(object):
     _data_map_scheme = {
         'XMLTagName.childXMLTagName': {
@@ -75,28 +307,113 @@ class ImportXML(object):
     id_xml_attr = 'Id'
     """str: аттрибут XML используемый для связи с БД"""
     data_map = None
-    """dict: схемы данных"""
+    """dict: схемы данных, по умолчанию settings.IMPORTXML_DATA_MAP"""
+    handlers = None
+    """dict: скомпилированные схемы данных data_name => DataHandler"""
+    create_order = None
+    """list: data_name в порядке создания записей, см. ImportXML.get_create_order"""
     key_map = None
     """dict: словари xml_id => site_id"""
     keys_get_lists = None
     """dict: списки xml_id для обновления key_map из БД"""
+    key_index = False
+    """bool: загружать key_map целиком один раз за импорт и поддерживать его без запросов, см. load_key_index"""
+    key_index_max = None
+    """dict: data_name => максимальный id таблицы, учтенный в key_map, для data_name с загруженным индексом"""
+    key_index_versions = None
+    """dict: data_name => версия индекса (см. cache_versions) на момент загрузки key_map"""
     keys_del_lists = None
     """dict: списки xml_id для удаления записей из БД"""
     unresolved_keys = None
-    """dict: списки site_id для обновления в БД их внешних ключей"""
+    """dict: списки xml_id записей и их внешних ключей для обновления в БД после создания связанных объектов"""
+    interned = None
+    """dict: таблица xml_id, чтобы одинаковые xml_id записей и внешних ключей хранились одной строкой"""
+    memory = None
+    """dict: этап => размер памяти процесса после этапа в байтах"""
+    summary = None
+    """ImportSummary: метрики этапов последнего обработанного файла"""
+    stage_metrics = None
+    """dict: метрики выполняемого этапа"""
+    count_queries = True
+    """bool: считать запросы к БД по этапам"""
+    query_counter = None
     create_without_xml_id = None
     """dict: списки записей для создания, которые не имеют своих xml_id"""
     files_lists = None
     """dict: списки записей для сохранения файлов"""
     flush = None
     files_dir = None
+    files_zip = None
+    """zipfile.ZipFile: архив, из которого читаются файлы вместо ImportXML.files_dir (должен быть открыт по пути)"""
+    files_threads = 4
+    """int: количество потоков, копирующих файлы в хранилище"""
+    files_save_signals = False
+    """bool: сохранять записи с новыми файлами через save() с сигналами pre_save/post_save, а не bulk_update"""
+    files_stats = None
+    """dict: счетчики этапа сохранения файлов"""
     exec_time = None
+    iterparse = False
+    """bool: разбирать файл потоково через etree.iterparse, не загружая его целиком в память"""
+    parse_processes = 1
+    """int: количество процессов, по которым распределяется разбор дочерних элементов корня xml"""
+    parse_shard_size = 1000
+    """int: количество дочерних элементов корня xml в одной части при разборе в нескольких процессах"""
+    shard_queues = ('keys_get_lists', 'keys_del_lists', 'create_without_xml_id', 'files_lists', 'post_save_models')
+    """tuple: очереди, заполняемые при разборе и объединяемые после разбора в нескольких процессах"""
+    memory_budget = None
+    """int: максимальное количество записей разбора в памяти, сверх которого списки записей сбрасываются
+    во временные файлы, см. spool.Spooler. По умолчанию не ограничено"""
+    spool_dir = None
+    """str: папка временных файлов списков записей, по умолчанию системная"""
+    spooler = None
+    """Spooler: бюджет памяти списков записей обрабатываемого файла"""
+    spooled_queues = ('create_without_xml_id', 'files_lists')
+    """tuple: очереди, списки которых учитываются в бюджете памяти ImportXML.memory_budget"""
     raise_unresolved_errors = True
+    update_batch_size = 500
+    """int: максимальное количество записей, обновляемых одним UPDATE запросом"""
+    delete_batch_size = 500
+    """int: максимальное количество xml_id в одном запросе удаления"""
+    staging = False
+    """bool: создавать и обновлять записи через временные таблицы set-based запросами, см. staging_create_records"""
+    fast_flush = True
+    """bool: очищать модели при Flush сырыми запросами, если у них нет сигналов удаления и внешних связей"""
+    commit_every = None
+    """int: фиксировать транзакцию каждые N записей и после каждого этапа вместо одной транзакции на файл"""
+    import_id = None
+    """str: идентификатор импорта для контрольной точки, по которой прерванный импорт продолжается"""
+    checkpoint_dir = None
+    """str: папка контрольных точек, по умолчанию MEDIA_ROOT/import_checkpoints"""
+    checkpoint = None
+    """dict: контрольная точка, с которой продолжается импорт: import_id, stage, data_names, data_name, xml_id"""
+    chunks_done = None
+    """list: data_name, полностью обработанные на текущем этапе"""
+    fingerprints = None
+    """FingerprintStore: отпечатки записей прошлых импортов, включается settings.IMPORTXML_FINGERPRINTS"""
+    skipped = None
+    """dict: количество неизмененных записей по data_name, пропущенных по отпечаткам"""
+    created_keys = None
+    """dict: списки xml_id созданных записей по data_name"""
+    updated_keys = None
+    """dict: списки xml_id обновленных записей по data_name"""
+    deleted_keys = None
+    """dict: списки xml_id удаленных записей по data_name"""
+    changed_models = None
+    """set: метки моделей, записи которых изменены, в том числе каскадным удалением и записи без xml_id"""
+    invalidate_cache = True
+    """bool: сбрасывать после импорта версии кеша измененных моделей и отправлять сигнал records_changed"""
+    stages = ('flush', 'delete', 'create', 'unresolved_keys', 'update', 'files', 'post_save', 'without_id', 'done')
+    """tuple: этапы импорта в порядке выполнения"""
+    chunked_stages = ('create', 'update', 'files', 'without_id')
+    """tuple: этапы, фиксирующие транзакцию по пачкам записей"""
 
     def __init__(self, flush=False):
-        if not hasattr(settings, 'IMPORTXML_DATA_MAP'):
-            raise ImproperlyConfigured('отсуствует settings.IMPORTXML_DATA_MAP')
-        self.data_map = settings.IMPORTXML_DATA_MAP
+        if self.data_map is None:
+            if not hasattr(settings, 'IMPORTXML_DATA_MAP'):
+                raise ImproperlyConfigured('отсуствует settings.IMPORTXML_DATA_MAP')
+            self.data_map = settings.IMPORTXML_DATA_MAP
+        self.handlers = self.compile_data_map()
+        self.create_order = self.get_create_order()
         self.key_map = {}
         for data_name, data in self.data_map.items():
             self.key_map[data_name] = {}
@@ -106,7 +423,57 @@ class ImportXML(object):
         self.create_without_xml_id = {}
         self.files_lists = {}
         self.post_save_models = {}
+        self.interned = {}
+        self.memory = {}
         self.flush = flush
+        if getattr(settings, 'IMPORTXML_FINGERPRINTS', None):
+            self.fingerprints = FingerprintStore(settings.IMPORTXML_FINGERPRINTS)
+        self.key_index = getattr(settings, 'IMPORTXML_KEY_INDEX', False)
+        self.memory_budget = getattr(settings, 'IMPORTXML_MEMORY_BUDGET', None)
+        self.staging = getattr(settings, 'IMPORTXML_STAGING', False)
+        if self.staging:
+            for data_name, handler in self.handlers.items():
+                if handler.model._meta.parents:
+                    raise ImproperlyConfigured('%s: модели с наследованием таблиц не поддерживают staging' % data_name)
+        self.key_index_max = {}
+        self.key_index_versions = {}
+
+    def add_deleted(self, result):
+        """
+        Добавляет модели, записи которых удалены, в ImportXML.changed_models
+
+        Args:
+            result (tuple): результат QuerySet.delete() – (количество, {метка модели: количество})
+
+        Returns:
+            int: количество удаленных записей
+        """
+        deleted, counts = result
+        self.changed_models.update(label for label, count in counts.items() if count)
+        return deleted
+
+    def add_created_keys(self, data_name, model, create_list, keys_list):
+        """
+        Добавляет созданные записи в ImportXML.key_map сразу после создания, чтобы следующие модели
+        ссылались на них без обновления после создания: по id объектов, если БД возвращает их из bulk_create
+        (PostgreSQL), иначе запросом записей с id больше учтенного в индексе либо запросами по xml_id
+        """
+        if create_list and all(obj.pk is not None for obj in create_list):
+            keys = {getattr(obj, self.id_field): obj.pk for obj in create_list}
+        elif data_name in self.key_index_max:
+            keys = self.fetch_keys(model, id__gt=self.key_index_max[data_name])
+        else:
+            keys = {}
+            for batch in chunks(keys_list, self.update_batch_size):
+                keys.update(self.fetch_keys(model, **{'%s__in' % self.id_field: batch}))
+        self.key_map[data_name].update(keys)
+        if keys and data_name in self.key_index_max:
+            self.key_index_max[data_name] = max(self.key_index_max[data_name], max(keys.values()))
+
+    def add_rows(self, count):
+        """Добавляет количество обработанных записей к метрикам выполняемого этапа"""
+        if self.stage_metrics is not None:
+            self.stage_metrics['rows'] += count
 
     def append_keys(self, data_name, keys, key_list=None):
         """Добавляет запись(и) в списки сгруппированные по data_name"""
@@ -114,41 +481,515 @@ class ImportXML(object):
             key_list = self.keys_get_lists
 
         if data_name not in key_list:
-            key_list[data_name] = []
+            spooled = any(key_list is getattr(self, name) for name in self.spooled_queues)
+            key_list[data_name] = self.new_list() if spooled else []
         if isinstance(keys, list):
             key_list[data_name] += keys
         else:
             key_list[data_name].append(keys)
 
+    def bulk_update(self, model, items):
+        """
+        Обновляет записи пачками: записи группируются по набору изменяемых полей,
+        каждая пачка группы обновляется одним UPDATE с CASE по site_id
+
+        Args:
+            model (django.db.models.Model): модель обновляемых записей
+            items (list): список пар (site_id, fields) в порядке обновления
+        """
+        groups = OrderedDict()
+        for site_id, fields in items:
+            if fields:
+                groups.setdefault(tuple(sorted(fields)), OrderedDict())[site_id] = fields
+
+        for field_names, group in groups.items():
+            output_fields = {name: model._meta.get_field(name) for name in field_names}
+            batch_size = connection.ops.bulk_batch_size(['pk'] * (2 * len(field_names) + 1), list(group))
+            batch_size = max(1, min(self.update_batch_size, batch_size))
+            for batch in chunks(list(group), batch_size):
+                if len(batch) == 1:
+                    model.objects.filter(pk=batch[0]).update(**group[batch[0]])
+                    continue
+                model.objects.filter(pk__in=batch).update(**{
+                    name: self.cast_case(Case(
+                        *[When(pk=site_id, then=Value(group[site_id][name], output_field=output_field))
+                          for site_id in batch],
+                        output_field=output_field), output_field)
+                    for name, output_field in output_fields.items()})
+
+    def call_post_save_callbacks(self):
+        """Вызывает post_save_callback моделей для созданных и обновленных записей"""
+        for model, items in self.post_save_models.items():
+            model.post_save_callback(items)
+            self.add_rows(len(items))
+
+    def can_fast_flush(self, models):
+        """
+        Проверяет, можно ли очистить модели сырыми запросами в обход Collector: у моделей нет сигналов
+        удаления, родительских моделей, many to many и generic связей, а ссылаются на них только модели из models.
+        Кроме PostgreSQL, где TRUNCATE очищает таблицы разом, модели не должны ссылаться сами на себя:
+        DELETE без условий проверяет внешние ключи построчно (MySQL), и ссылка на еще не удаленную строку
+        той же таблицы прерывает запрос
+        """
+        for model in models:
+            if model._meta.parents or model._meta.many_to_many or model._meta.private_fields:
+                return False
+            if pre_delete.has_listeners(model) or post_delete.has_listeners(model):
+                return False
+            if any(rel.related_model not in models for rel in self.get_related_objects(model)):
+                return False
+            if connection.vendor != 'postgresql' and any(
+                    rel.related_model is model for rel in self.get_related_objects(model)):
+                return False
+        return True
+
+    def cast_case(self, case, output_field):
+        """
+        Приводит CASE к типу поля в PostgreSQL: значения, которые драйвер передает строками
+        (например DecimalField), иначе дают CASE типа text, и UPDATE колонки другого типа падает
+        """
+        if connection.vendor == 'postgresql':
+            return Cast(case, output_field)
+        return case
+
     def clean_datetime_field(self, value):
         """Конвертирует строку в datetime.datetime"""
         return tz.localize(parse_datetime(value))
 
+    def compile_data_map(self):
+        """
+        Компилирует ImportXML.data_map в DataHandler: загружает модели, привязывает функции очистки
+        и строит таблицы дочерних элементов, так что ошибки схемы обнаруживаются до начала импорта
+
+        Returns:
+            dict: data_name => DataHandler
+        """
+        handlers = {data_name: DataHandler(self, data_name, data_map) for data_name, data_map in self.data_map.items()}
+        for data_name, handler in handlers.items():
+            if '.' not in data_name:
+                continue
+            parent_name, tag = data_name.rsplit('.', 1)
+            if parent_name not in handlers:
+                raise ImproperlyConfigured('%s: отсуствует %s в ImportXML.data_map' % (data_name, parent_name))
+            parent = handlers[parent_name]
+            if not parent.children_key_field:
+                raise ImproperlyConfigured('%s: отсуствует children_key_field' % parent_name)
+            handler.check_field(data_name, handler.model, parent.children_key_field)
+            handler.add_foreign_key(parent.children_key_field, parent_name)
+            parent.children[tag] = handler
+        return handlers
+
+    @contextmanager
+    def commit_chunk(self, stage, data_name=None, xml_id=None):
+        """
+        Выполняет блок в отдельной транзакции и сохраняет после ее фиксации контрольную точку,
+        если импорт идет с промежуточной фиксацией (ImportXML.commit_every)
+
+        Args:
+            stage (str): этап из ImportXML.stages
+            data_name (str): ключ ImportXML.data_map последней обработанной записи, None – весь этап
+            xml_id (str): xml_id последней обработанной записи
+        """
+        if not self.commit_every:
+            yield
+            return
+        if connection.in_atomic_block:
+            # во внешней транзакции atomic создает savepoint, пачки не фиксируются, и контрольная точка
+            # указывала бы на данные, которые откатятся вместе с внешней транзакцией
+            raise transaction.TransactionManagementError(
+                'ImportXML.commit_every requires autocommit mode, the import is running in an atomic block')
+        with transaction.atomic():
+            yield
+        self.save_checkpoint(stage, data_name, xml_id)
+
+    def create_records(self, create_items):
+        """
+        Создает новые записи пачками по ImportXML.commit_every в порядке ImportXML.create_order,
+        так что внешние ключи ссылаются на уже созданные записи
+        """
+        create_items = OrderedDict(
+            (data_name, create_items[data_name]) for data_name in self.create_order if data_name in create_items)
+        for data_name, rows in self.iter_chunks('create', create_items):
+            handler = self.get_handler(data_name)
+            model = handler.model
+            with self.commit_chunk('create', data_name, rows[-1][1]):
+                self.prefetch_keys(handler, rows)
+                create_list, keys_list = [], []
+                for item in map(handler.unpack, rows):
+                    self.localize_keys(item)
+                    keys_list.append(item['xml_id'])
+                    item['fields'][self.id_field] = item['xml_id']
+                    create_list.append(model(**item['fields']))
+                self.append_keys(data_name, keys_list, self.created_keys)
+                log.info('create %s items..' % model.__name__)
+                model.objects.bulk_create(create_list)
+                self.add_created_keys(data_name, model, create_list, keys_list)
+                self.add_rows(len(create_list))
+
+    def create_records_without_xml_id(self):
+        """Создает записи без собственных xml_id, предварительно удаляя старые по delete_by_field"""
+        for data_name, rows in self.iter_chunks('without_id', self.create_without_xml_id, split=False):
+            handler = self.get_handler(data_name)
+            model = handler.model
+            log.info('create %s items..' % model.__name__)
+            # список может быть сброшен на диск, поэтому перебирается пачками по ImportXML.memory_budget
+            batch_size = self.memory_budget or len(rows) or 1
+            with self.commit_chunk('without_id', data_name):
+                if handler.delete_by_field:
+                    # значения delete_by_field собираются отдельным проходом, чтобы удаление
+                    # не затронуло записи, созданные из предыдущих пачек
+                    delete_list = set()
+                    for batch in iter_batches(rows, batch_size):
+                        for item in map(handler.unpack, batch):
+                            value = self.get_field_value(item, handler.delete_by_field)
+                            if value is not None:
+                                delete_list.add(value)
+                    for batch in chunks(list(delete_list), self.delete_batch_size):
+                        self.add_deleted(model.objects.filter(**{'%s__in' % handler.delete_by_field: batch}).delete())
+                for batch in iter_batches(rows, batch_size):
+                    create_list = []
+                    for item in map(handler.unpack, batch):
+                        self.localize_keys(item)
+                        create_list.append(model(**item['fields']))
+                    model.objects.bulk_create(create_list)
+                    self.add_rows(len(create_list))
+                self.changed_models.add(get_label(model))
+
+    def clear_checkpoint(self):
+        """Удаляет контрольную точку ImportXML.import_id после успешного завершения импорта"""
+        if self.import_id and path.exists(self.get_checkpoint_path()):
+            remove(self.get_checkpoint_path())
+
     def delete_keys(self):
         """Удаляет записи из БД из очереди ImportXML.keys_del_lists"""
+        cascaded = set()
         for data_name, keys in self.keys_del_lists.items():
             model = self.get_model(data_name)
-            model.objects.filter(**{'%s__in' % self.id_field: keys}).delete()
+            if self.staging and not self.get_related_objects(model) and self.can_fast_flush([model]):
+                self.staging_delete(model, keys)
+            else:
+                for batch in chunks(keys, self.delete_batch_size):
+                    result = model.objects.filter(**{'%s__in' % self.id_field: batch}).delete()
+                    self.add_deleted(result)
+                    cascaded.update(label for label, count in result[1].items() if count and label != get_label(model))
+            self.append_keys(data_name, keys, self.deleted_keys)
+            self.add_rows(len(keys))
+            if self.fingerprints:
+                self.fingerprints.delete_many(data_name, keys)
+            if data_name in self.key_index_max:
+                for key in keys:
+                    self.key_map[data_name].pop(key, None)
             del self.keys_del_lists[data_name]
 
-    def get_data_map(self, data_name):
-        """Возвращает объект из ImportXML.data_map либо вызывает исключение"""
-        data_map = self.data_map.get(data_name)
-        if data_map:
-            return data_map
+        # индексы моделей, записи которых удалены каскадно, загружаются заново
+        for data_name in self.key_index_max:
+            if get_label(self.get_model(data_name)) in cascaded:
+                self.key_map[data_name] = self.fetch_keys(self.get_model(data_name))
+
+    def fast_flush_models(self, models):
+        """
+        Очищает таблицы моделей без загрузки записей: TRUNCATE в PostgreSQL, в остальных БД – DELETE
+        без условий по каждой таблице (TRUNCATE в MySQL фиксирует транзакцию)
+
+        Args:
+            models (list): модели в порядке удаления, см. ImportXML.get_flush_order
+        """
+        tables = [connection.ops.quote_name(model._meta.db_table) for model in models]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('TRUNCATE %s' % ', '.join(tables))
+            else:
+                for table in tables:
+                    cursor.execute('DELETE FROM %s' % table)
+                    self.add_rows(cursor.rowcount)
+        self.changed_models.update(get_label(model) for model in models)
+
+    def fetch_keys(self, model, **filters):
+        """Возвращает словарь xml_id => site_id записей модели, читая их потоково через iterator()"""
+        return {self.intern_key(unicode(xml_id)): site_id for xml_id, site_id in model.objects.filter(
+            **filters).values_list(self.id_field, 'id').iterator()}
+
+    @contextmanager
+    def files_index(self, data_name):
+        """
+        Индексирует ImportXML.files_lists записей data_name за один проход и выдает функцию xml_ids => {xml_id: файлы}.
+        Список, сброшенный на диск, индексируется во временной sqlite базе (spool.SpoolIndex), остальные – словарем
+        """
+        files_list = self.files_lists.get(data_name, [])
+        if getattr(files_list, 'spilled', 0):
+            index = SpoolIndex(files_list, self.spooler.temp_dir)
+            try:
+                yield index.get_many
+            finally:
+                index.close()
+        else:
+            files = dict(files_list)
+            yield lambda xml_ids: {xml_id: files[xml_id] for xml_id in xml_ids if xml_id in files}
+
+    def flush_models(self):
+        """Удаляет все записи всех моделей из ImportXML.data_map"""
+        models = []
+        for data_name in self.data_map:
+            if self.get_model(data_name) not in models:
+                models.append(self.get_model(data_name))
+        if self.fast_flush and self.can_fast_flush(models):
+            self.fast_flush_models(self.get_flush_order(models))
         else:
-            # @TODO: log error && raise error
+            for model in models:
+                self.add_rows(self.add_deleted(model.objects.all().delete()))
+        if self.fingerprints:
+            for data_name in self.data_map:
+                self.fingerprints.clear(data_name)
+
+    def get_checkpoint_path(self):
+        """Возвращает путь к файлу контрольной точки ImportXML.import_id"""
+        checkpoint_dir = self.checkpoint_dir or path.join(settings.MEDIA_ROOT, 'import_checkpoints')
+        return path.join(checkpoint_dir, '%s.json' % self.import_id)
+
+    def get_create_order(self):
+        """
+        Возвращает data_name в порядке создания: модели, на которые ссылаются foreign_keys и children_key_field,
+        раньше ссылающихся на них. Ссылки на свой data_name и циклы обновляются после создания
+        в ImportXML.update_unresolved_keys
+        """
+        order = []
+
+        def visit(data_name, visiting):
+            if data_name in order or data_name in visiting:
+                return
+            for target_data_name in sorted(set(self.handlers[data_name].fk_targets.values())):
+                visit(target_data_name, visiting + [data_name])
+            order.append(data_name)
+
+        for data_name in sorted(self.handlers):
+            visit(data_name, [])
+        return order
+
+    def get_file_hash(self, f):
+        """Возвращает md5 содержимого файлового объекта, читая его блоками"""
+        file_hash = md5()
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def get_field_value(self, item, model_property):
+        """
+        Возвращает значение поля записи, как его заполнит ImportXML.localize_keys, не изменяя запись:
+        site_id внешнего ключа по ImportXML.key_map либо None, если связанная запись еще не известна
+        """
+        if model_property in item['foreign_keys']:
+            xml_id, target_data_name = item['foreign_keys'][model_property]
+            return self.key_map[target_data_name].get(xml_id) if xml_id != '' else None
+        return item['fields'].get(model_property)
+
+    def get_file_signature(self, file_name):
+        """
+        Возвращает признак содержимого файла без его чтения: размер и CRC из ImportXML.files_zip либо размер
+        и время изменения файла в ImportXML.files_dir, None – если файл не найден
+        """
+        try:
+            if self.files_zip:
+                info = self.files_zip.getinfo(file_name)
+                return [info.file_size, info.CRC]
+            if self.files_dir:
+                stat_result = stat(path.join(self.files_dir, file_name))
+                return [stat_result.st_size, stat_result.st_mtime]
+        except (KeyError, OSError):
             pass
+        return None
+
+    def get_fingerprint(self, item, files=None):
+        """
+        Возвращает отпечаток записи: md5 от полей, site_id внешних ключей по ImportXML.key_map и файлов.
+        Файлы учитываются вместе с признаком содержимого (ImportXML.get_file_signature), чтобы файл,
+        замененный под тем же именем, не пропускался вместе с записью
+
+        Args:
+            item (dict): массив, созданный в ImportXML.process_item
+            files (dict): файлы записи из ImportXML.files_lists
+        """
+        foreign_keys = {}
+        for model_property, (xml_id, target_data_name) in item['foreign_keys'].items():
+            foreign_keys[model_property] = self.key_map[target_data_name].get(xml_id) if xml_id != '' else None
+        fields = {key: value for key, value in item['fields'].items()
+                  if key not in foreign_keys and key != self.id_field}
+        if files:
+            files = {model_property: [file_name, self.get_file_signature(file_name)]
+                     for model_property, file_name in files.items()}
+        data = json.dumps([fields, foreign_keys, files], sort_keys=True, default=unicode)
+        return md5(data.encode('utf-8')).hexdigest()
+
+    def get_flush_order(self, models):
+        """Возвращает модели в порядке удаления: модели, ссылающиеся на другие модели, раньше них"""
+        ordered = []
+
+        def visit(model, visiting):
+            if model in ordered or model in visiting:
+                return
+            for rel in self.get_related_objects(model):
+                visit(rel.related_model, visiting + [model])
+            ordered.append(model)
+
+        for model in models:
+            visit(model, [])
+        return ordered
+
+    def get_handler(self, data_name):
+        """Возвращает DataHandler по ключу в ImportXML.data_map либо вызывает исключение"""
+        try:
+            return self.handlers[data_name]
+        except KeyError:
+            raise ImproperlyConfigured('отсуствует %s в ImportXML.data_map' % data_name)
 
     def get_model(self, data_name):
         """Возвращает модель по её ключу в ImportXML.data_map"""
-        data_map = self.get_data_map(data_name)
-        return apps.get_model(*data_map['model'].split('.'))
+        return self.get_handler(data_name).model
+
+    def get_related_objects(self, model):
+        """
+        Возвращает обратные связи моделей, ссылающихся на model, как их обходит Collector при удалении:
+        в отличие от _meta.related_objects, включая скрытые связи с related_name='+'
+        """
+        return [field for field in model._meta.get_fields(include_hidden=True)
+                if field.auto_created and not field.concrete and (field.one_to_many or field.one_to_one)]
+
+    def get_max_id(self, model):
+        """Возвращает максимальный id таблицы модели или 0, если таблица пуста"""
+        return model.objects.aggregate(max_id=Max('id'))['max_id'] or 0
 
     def get_xml_id(self, xml):
         """Возвращает xml_id с инстанса etree._Element"""
         return xml.attrib[self.id_xml_attr]
 
+    def intern_key(self, xml_id):
+        """Возвращает xml_id из таблицы ImportXML.interned, добавляя его туда при первом появлении"""
+        return self.interned.setdefault(xml_id, xml_id)
+
+    def intern_row(self, row):
+        """Возвращает кортеж записи, xml_id и внешние ключи которого взяты из таблицы ImportXML.interned"""
+        handler = self.get_handler(row[0])
+        row = list(row)
+        row[0], row[1] = handler.data_name, self.intern_key(row[1])
+        for column in handler.fk_targets:
+            index = handler.columns.index(column) + 2
+            if row[index] is not MISSING:
+                row[index] = self.intern_key(row[index])
+        return tuple(row)
+
+    def is_stage_done(self, stage):
+        """Проверяет по контрольной точке ImportXML.checkpoint, был ли этап полностью выполнен ранее"""
+        if not self.checkpoint:
+            return False
+        done = self.stages.index(self.checkpoint['stage'])
+        current = self.stages.index(stage)
+        return done > current or (done == current and self.checkpoint['data_name'] is None)
+
+    def iter_chunks(self, stage, grouped_items, get_xml_id=itemgetter(1), split=True):
+        """
+        Перебирает пачки записей этапа по ImportXML.commit_every (по ImportXML.memory_budget, если списки
+        записей учитываются в бюджете памяти), пропуская data_name и записи,
+        уже обработанные до контрольной точки ImportXML.checkpoint. Порядок записей при повторном запуске
+        может отличаться (созданные ранее записи попадают в обновление), поэтому полностью обработанные
+        data_name хранятся списком, а не позицией
+
+        Args:
+            stage (str): этап из ImportXML.stages
+            grouped_items (dict): списки записей, сгруппированные по data_name
+            get_xml_id (callable): возвращает xml_id записи
+            split (bool): делить ли список записей data_name на пачки, иначе список передается как есть,
+                без загрузки в память
+
+        Yields:
+            tuple: (data_name, list)
+        """
+        checkpoint = self.checkpoint if self.checkpoint and self.checkpoint['stage'] == stage else None
+        self.chunks_done = list(checkpoint['data_names']) if checkpoint else []
+        size = self.commit_every or self.spooler and self.memory_budget
+        for data_name, items in grouped_items.items():
+            if data_name in self.chunks_done:
+                continue
+            if not split:
+                # список обрабатывается целиком в одной транзакции, поэтому отмечается выполненным до нее,
+                # и контрольная точка после ее фиксации уже содержит data_name
+                self.chunks_done.append(data_name)
+                yield data_name, items
+                continue
+            chunk_size = size or len(items) or 1
+            if checkpoint and checkpoint['data_name'] == data_name and any(
+                    get_xml_id(item) == checkpoint['xml_id'] for item in items):
+                items = iter(items)
+                for item in items:
+                    if get_xml_id(item) == checkpoint['xml_id']:
+                        break
+            # списки в бюджете памяти перебираются потоково, без загрузки целиком
+            for chunk in iter_batches(items, chunk_size):
+                yield data_name, chunk
+            self.chunks_done.append(data_name)
+
+    def iterparse_items(self, f):
+        """
+        Потоково разбирает XML, возвращая корневой элемент и генератор его дочерних элементов.
+        Каждый дочерний элемент отдается после его полного разбора, а после обработки очищается
+        вместе с уже обработанными соседями, поэтому в памяти одновременно находится только один элемент.
+
+        Args:
+            f (file): файловый объект с XML
+
+        Returns:
+            tuple: (etree._Element, generator)
+        """
+        context = etree.iterparse(f, events=('start', 'end'))
+        event, root = next(context)
+
+        def items():
+            depth = 1
+            for event, element in context:
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    yield element
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del root[0]
+
+        return root, items()
+
+    def load_checkpoint(self):
+        """Загружает контрольную точку ImportXML.import_id, если импорт идет с промежуточной фиксацией"""
+        if not (self.commit_every and self.import_id):
+            return None
+        checkpoint_path = self.get_checkpoint_path()
+        if not path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, 'r') as f:
+            return json.load(f)
+
+    def load_key_index(self):
+        """
+        Загружает ImportXML.key_map всех data_name с xml_id из снимка key_indexes, если версия индекса модели
+        и ее максимальный id не изменились после его сохранения, иначе одним потоковым запросом на модель.
+        Дальше индекс обновляется при создании и удалении записей, и ImportXML.update_keys не обращается к БД
+        для этих data_name. Версии хранятся в кеше, поэтому снимки между процессами требуют общего бэкенда кеша
+        """
+        self.key_index_max = {}
+        self.key_index_versions = {}
+        for data_name, handler in self.handlers.items():
+            if handler.without_id:
+                continue
+            # версия читается до таблицы: изменение после чтения увеличит ее и не даст сохранить снимок
+            version = get_key_index_version(handler.model)
+            max_id = self.get_max_id(handler.model)
+            snapshot = key_indexes.get((get_label(handler.model), self.id_field))
+            if version is not None and snapshot and snapshot[:2] == (version, max_id):
+                self.key_map[data_name] = dict(snapshot[2])
+            else:
+                self.key_map[data_name] = self.fetch_keys(handler.model, id__lte=max_id)
+                self.add_rows(len(self.key_map[data_name]))
+            self.key_index_max[data_name] = max_id
+            self.key_index_versions[data_name] = version
+
     def localize_keys(self, data):
         """
         Обновляет data, заменяя различные xml_id из foreign_keys на site_id в fields, если объект существует в БД,
@@ -167,233 +1008,791 @@ class ImportXML(object):
                     data['fields'][model_property] = self.key_map[target_data_name][xml_id]
                 else:
                     self.append_keys(target_data_name, [xml_id])
-                    if data['data_name'] not in self.unresolved_keys:
-                        self.unresolved_keys[data['data_name']] = {}
-                    if target_data_name not in self.unresolved_keys[data['data_name']]:
-                        self.unresolved_keys[data['data_name']][target_data_name] = {}
-                    if model_property not in self.unresolved_keys[data['data_name']][target_data_name]:
-                        self.unresolved_keys[data['data_name']][target_data_name][model_property] = {}
-                    if xml_id not in self.unresolved_keys[data['data_name']][target_data_name][model_property]:
-                        self.unresolved_keys[data['data_name']][target_data_name][model_property][xml_id] = []
-                    # self.unresolved_keys[ContractorLegal][ContractorRegion][region_id][123] = ['1', '2', '3']
-                    self.unresolved_keys[data['data_name']][target_data_name][model_property][xml_id].append(data['xml_id'])
+                    # self.unresolved_keys[ContractorLegal][(region_id, ContractorRegion)] = (['1', '2'], ['12', '12'])
+                    items_xml_id, targets_xml_id = self.unresolved_keys.setdefault(data['data_name'], {}).setdefault(
+                        (model_property, target_data_name), ([], []))
+                    items_xml_id.append(data['xml_id'])
+                    targets_xml_id.append(xml_id)
+
+    @contextmanager
+    def measure(self, stage):
+        """
+        Измеряет этап: время, количество записей (ImportXML.add_rows), запросов к БД и пик памяти,
+        добавляет метрики в ImportXML.summary и отправляет сигнал stage_done. Метрики этапа, прерванного
+        исключением, тоже добавляются и отправляются, с флагом error
+        """
+        metrics = self.stage_metrics = {'rows': 0, 'error': False}
+        queries = self.query_counter.count if self.query_counter else 0
+        reset_peak_rss()
+        start = time.time()
+        try:
+            yield metrics
+        except BaseException:
+            metrics['error'] = True
+            raise
+        finally:
+            metrics['time'] = time.time() - start
+            metrics['queries'] = (self.query_counter.count if self.query_counter else 0) - queries
+            metrics['rss'] = self.memory[stage] = get_rss()
+            metrics['peak_rss'] = get_peak_rss()
+            self.stage_metrics = None
+            self.summary.add(stage, metrics)
+            log.info('%s%s: %.2fs, %i rows, %i queries, rss %.1f MB, peak %.1f MB' % (
+                stage, ' (failed)' if metrics['error'] else '', metrics['time'], metrics['rows'], metrics['queries'],
+                metrics['rss'] / 1048576.0, metrics['peak_rss'] / 1048576.0))
+            if metrics['error']:
+                # ошибка обработчика не должна заменять исключение этапа
+                for receiver, response in stage_done.send_robust(
+                        sender=self.__class__, import_xml=self, stage=stage, metrics=metrics):
+                    if isinstance(response, Exception):
+                        log.error('stage_done receiver %r failed: %s' % (receiver, response))
+            else:
+                stage_done.send(sender=self.__class__, import_xml=self, stage=stage, metrics=metrics)
+
+    def merge_shard(self, result, data_list):
+        """Добавляет записи и очереди части xml, разобранной в parse_shard, к записям и очередям ImportXML"""
+        # строки из дочернего процесса приходят новыми объектами, поэтому xml_id заменяются строками из
+        # ImportXML.interned, как при последовательном разборе
+        data_list += [self.intern_row(row) for row in result[0]]
+        for name, queues in izip(self.shard_queues, result[1:]):
+            for data_name, keys in queues.items():
+                if name == 'create_without_xml_id':
+                    keys = [self.intern_row(row) for row in keys]
+                elif name == 'files_lists':
+                    keys = [(self.intern_key(xml_id), files) for xml_id, files in keys]
+                else:
+                    keys = [self.intern_key(key) for key in keys]
+                self.append_keys(data_name, keys, getattr(self, name))
+
+    def new_list(self):
+        """Возвращает список записей, учитываемый в бюджете памяти ImportXML.spooler, если он задан"""
+        return self.spooler.new() if self.spooler else []
+
+    def open_file(self, file_name):
+        """Открывает файл для сохранения из ImportXML.files_zip либо из ImportXML.files_dir"""
+        if self.files_zip:
+            return self.files_zip.open(file_name)
+        return open(path.join(self.files_dir, file_name), 'rb')
+
+    def parse_parallel(self, items, data_list):
+        """
+        Разбирает дочерние элементы корня xml в ImportXML.parse_processes процессах. Элементы сериализуются
+        частями по ImportXML.parse_shard_size, результаты частей объединяются в исходном порядке, поэтому
+        записи и очереди совпадают с последовательным разбором. Одновременно в работе не больше двух частей
+        на процесс, чтобы при ImportXML.iterparse файл не накапливался в памяти
+
+        Args:
+            items (iterable): дочерние элементы корня
+            data_list (list): список, в который добавляются кортежи записей
+        """
+        global shard_import_xml
+        shard_import_xml = self
+        pool = Pool(self.parse_processes)
+        pending = deque()
+        try:
+            shard = []
+            for item in items:
+                shard.append(etree.tostring(item, with_tail=False))
+                if len(shard) >= self.parse_shard_size:
+                    pending.append(pool.apply_async(parse_shard, (b'<Shard>%s</Shard>' % b''.join(shard),)))
+                    shard = []
+                    if len(pending) >= 2 * self.parse_processes:
+                        self.merge_shard(pending.popleft().get(), data_list)
+            if shard:
+                pending.append(pool.apply_async(parse_shard, (b'<Shard>%s</Shard>' % b''.join(shard),)))
+            while pending:
+                self.merge_shard(pending.popleft().get(), data_list)
+        finally:
+            pool.terminate()
+            shard_import_xml = None
 
     def process_item(self, element, data_list, parent=None):
         """
-        Обрабатывает один элемент из xml, создавая словарь item_data, добавляемый в data_list
+        Обрабатывает один элемент из xml, создавая словарь item_data, который упаковывается
+        в кортеж записи DataHandler.pack и добавляется в data_list
 
         Args:
             element (ElementWrapper, etree._Element): либо xml элемент, либо содержащий его ElementWrapper
-            data_list (list): список, в который добавляется item_data
+            data_list (list): список, в который добавляется кортеж записи
             parent (ElementWrapper): родительский элемент, если есть
         """
         if not isinstance(element, ElementWrapper):
             element = ElementWrapper(element, element.tag)
 
-        if 'DoRemove' in element.xml.attrib and element.xml.attrib['DoRemove'] == 'true':
+        if element.xml.attrib.get('DoRemove') == 'true':
             self.append_keys(element.data_name, self.get_xml_id(element.xml), self.keys_del_lists)
         else:
-            data_map = self.get_data_map(element.data_name)
+            handler = self.get_handler(element.data_name)
             item_data = {
                 'data_name': element.data_name,
-                'xml_id': self.get_xml_id(element.xml),
+                'xml_id': self.intern_key(self.get_xml_id(element.xml)),
                 'fields': {},
                 'foreign_keys': {}}
-            self.update_item_data(element.xml, data_map, item_data)
+            self.update_item_data(element.xml, handler, item_data)
             if parent:
-                parent_map = self.get_data_map(parent.data_name)
-                item_data['foreign_keys'][parent_map['children_key_field']] = (
-                    self.get_xml_id(parent.xml), parent.data_name)
-
-            for child in element.xml.getchildren():
-                child = ElementWrapper(child, '%s.%s' % (element.data_name, child.tag))
-                if 'children_fields' in data_map and child.xml.tag in data_map['children_fields']:
-                    self.update_item_data(child.xml, data_map['children_fields'][child.xml.tag], item_data)
-                elif child.data_name in self.data_map:
-                    self.process_item(child, data_list, element)
-
-            if 'without_id' in data_map:
-                self.append_keys(element.data_name, item_data, self.create_without_xml_id)
+                item_data['foreign_keys'][self.handlers[parent.data_name].children_key_field] = (
+                    self.intern_key(self.get_xml_id(parent.xml)), parent.data_name)
+
+            for child in element.xml.iterchildren():
+                if child.tag in handler.children_fields:
+                    self.update_item_data(child, handler.children_fields[child.tag], item_data)
+                elif child.tag in handler.children:
+                    self.process_item(ElementWrapper(child, handler.children[child.tag].data_name), data_list, element)
+
+            if handler.without_id:
+                self.append_keys(element.data_name, handler.pack(item_data), self.create_without_xml_id)
             else:
-                self.append_keys(element.data_name, self.get_xml_id(element.xml))
-                model = self.get_model(element.data_name)
-                if hasattr(model, 'post_save_callback'):
-                    self.append_keys(model, item_data['xml_id'], self.post_save_models)
-                data_list.append(item_data)
+                self.append_keys(element.data_name, item_data['xml_id'])
+                if handler.post_save_callback:
+                    self.append_keys(handler.model, item_data['xml_id'], self.post_save_models)
+                data_list.append(handler.pack(item_data))
+
+    def prefetch_keys(self, handler, rows):
+        """
+        Загружает в ImportXML.key_map site_id внешних ключей пачки записей, которых еще нет в key_map,
+        чтобы ссылки на записи, отсутствующие в файле, но существующие в БД, заполнялись при создании и обновлении
+        """
+        for column, target_data_name in handler.fk_targets.items():
+            if target_data_name in self.key_index_max:
+                continue
+            index = handler.columns.index(column) + 2
+            target_keys = self.key_map[target_data_name]
+            missing = {row[index] for row in rows
+                       if row[index] is not MISSING and row[index] != '' and row[index] not in target_keys}
+            model = self.get_model(target_data_name)
+            for batch in chunks(list(missing), self.update_batch_size):
+                target_keys.update(self.fetch_keys(model, **{'%s__in' % self.id_field: batch}))
 
     def process_file(self, file_path):
-        """Создает объект XML из файла и запускает парсер ImportXML.process_xml"""
-        with open(file_path, 'r') as f:
+        """Открывает файл и запускает парсер ImportXML.process_stream"""
+        with open(file_path, 'rb') as f:
+            return self.process_stream(f)
+
+    def process_stream(self, f):
+        """Создает объект XML из файлового объекта и запускает парсер ImportXML.process_xml"""
+        if self.iterparse:
+            xml, items = self.iterparse_items(f)
+        else:
             xml = etree.fromstring(f.read())
-            with transaction.atomic():
-                self.process_xml(xml)
+            items = None
+        if self.commit_every:
+            return self.process_xml(xml, items)
+        with transaction.atomic():
+            return self.process_xml(xml, items)
 
-    def process_xml(self, xml):
-        """Обрабатывает корневой XML элемент, создавая / изменяя / удаляя записи из БД"""
+    def process_xml(self, xml, items=None):
+        """
+        Обрабатывает корневой XML элемент, создавая / изменяя / удаляя записи из БД
+
+        Args:
+            xml (etree._Element): корневой элемент
+            items (iterable): дочерние элементы корня, по умолчанию xml.getchildren()
+
+        Returns:
+            ImportSummary: метрики этапов импорта
+        """
+        self.summary = ImportSummary()
+        if self.count_queries:
+            with QueryCounter() as self.query_counter:
+                self.process_stages(xml, items)
+            self.query_counter = None
+        else:
+            self.process_stages(xml, items)
+        import_done.send(sender=self.__class__, import_xml=self, summary=self.summary)
+        return self.summary
+
+    def process_stages(self, xml, items=None):
+        """Выполняет этапы импорта корневого XML элемента, см. ImportXML.process_xml"""
+        if items is None:
+            items = xml.getchildren()
         self.exec_time = datetime.now()
-        data_list = []
-        create_items = {}
-        update_items = {}
+        self.checkpoint = self.load_checkpoint()
+        if self.is_stage_done('done'):
+            log.info('import %s is already done' % self.import_id)
+            return
+        self.spooler = Spooler(self.memory_budget, self.spool_dir) if self.memory_budget else None
+        self.unresolved_keys = {}
+        self.create_without_xml_id = {}
+        self.files_lists = {}
+        self.post_save_models = {}
+        self.created_keys = {}
+        self.updated_keys = {}
+        self.deleted_keys = {}
+        self.changed_models = set()
+        data_list = self.new_list()
+        create_items = OrderedDict()
+        update_items = OrderedDict()
 
         if ('Flush' in xml.attrib and xml.attrib['Flush'] == 'true') or self.flush:
-            for data_name, data in self.data_map.items():
-                model = self.get_model(data_name)
-                model.objects.all().delete()
+            self.run_stage('flush', self.flush_models)
+
+        if self.key_index:
+            with self.measure('key_index'):
+                self.load_key_index()
 
         # собирается список данных из xml
-        for item in xml.getchildren():
-            self.process_item(item, data_list)
+        with self.measure('parse'):
+            if self.parse_processes > 1:
+                self.parse_parallel(items, data_list)
+            else:
+                for item in items:
+                    self.process_item(item, data_list)
+            self.add_rows(len(data_list) + sum(len(rows) for rows in self.create_without_xml_id.values()))
 
         # удаляются записиси из БД
         log.info('delete keys..')
-        self.delete_keys()
+        self.run_stage('delete', self.delete_keys)
         self.update_keys()
 
         # распределяется список данных на создание и обновление
-        for item in data_list:
-            target = update_items if item['xml_id'] in self.key_map[item['data_name']] else create_items
-            if item['data_name'] not in target:
-                target[item['data_name']] = []
-            target[item['data_name']].append(item)
+        for row in data_list:
+            data_name, xml_id = row[0], row[1]
+            target = update_items if xml_id in self.key_map[data_name] else create_items
+            if data_name not in target:
+                target[data_name] = self.new_list()
+            target[data_name].append(row)
+        del data_list
+        if self.spooler and self.spooler.spills:
+            log.info('records spilled to disk %i times' % self.spooler.spills)
+
+        # пропускаются записи, не изменившиеся с прошлого импорта
+        if self.fingerprints:
+            self.skip_unchanged(update_items)
+            self.summary.skipped = self.skipped
 
         # создаются новые записи
         log.info('create items..')
-        for data_name, items in create_items.items():
-            model = self.get_model(data_name)
-            create_list, keys_list = [], []
-            for item in items:
-                self.localize_keys(item)
-                keys_list.append(item['xml_id'])
-                item['fields'][self.id_field] = item['xml_id']
-                create_list.append(model(**item['fields']))
-            self.append_keys(data_name, keys_list)
-            log.info('create %s items..' % model.__name__)
-            model.objects.bulk_create(create_list)
+        self.run_stage('create', self.staging_create_records if self.staging else self.create_records, create_items)
         self.update_keys()
 
         # обновление ссылок на только созданные объекты
         log.info('update unresolved keys..')
-        for data_name, _data_name in self.unresolved_keys.items():
-            model = self.get_model(data_name)
-            for target_data_name, _target_data_name in _data_name.items():
-                for model_property, _model_property in _target_data_name.items():
-                    for xml_id, items_xml_id in _model_property.items():
-                        try:
-                            field_val = self.key_map[target_data_name][xml_id]
-                            model.objects.filter(**{'%s__in' % self.id_field: items_xml_id}).update(
-                                **{model_property: field_val})
-                        except KeyError as e:
-                            if self.raise_unresolved_errors:
-                                raise e
+        self.run_stage('unresolved_keys', self.update_unresolved_keys)
 
         # обновляются существующие записи
         log.info('update items..')
-        for data_name, items in update_items.items():
-            model = self.get_model(data_name)
-            log.info('update %s items..' % model.__name__)
-            for item in items:
-                self.localize_keys(item)
-                model.objects.filter(**{self.id_field: item['xml_id']}).update(**item['fields'])
+        self.run_stage('update', self.staging_update_records if self.staging else self.update_records, update_items)
 
         # сохраняются файлы
         log.info('saving files..')
-        for data_name, files_list in self.files_lists.items():
-            model = self.get_model(data_name)
-            log.info('saving %s files..' % model.__name__)
-            for xml_id, item_files in files_list:
-                instance = model.objects.get(**{self.id_field: xml_id})
-                for model_property, file_name in item_files.items():
-                    getattr(instance, model_property).save(file_name, File(open(path.join(self.files_dir, file_name))))
+        self.run_stage('files', self.save_files)
+        self.summary.files = self.files_stats or {}
 
         log.info('post save callbacks..')
-        for model, items in self.post_save_models.items():
-            model.post_save_callback(items)
+        self.run_stage('post_save', self.call_post_save_callbacks)
 
         # создаются объекты без собственных xml_id
         log.info('create items without xml_id..')
-        for data_name, items in self.create_without_xml_id.items():
-            model = self.get_model(data_name)
-            data_map = self.get_data_map(data_name)
-            log.info('create %s items..' % model.__name__)
-            create_list, delete_list = [], []
-            for item in items:
-                self.localize_keys(item)
-                if 'delete_by_field' in data_map:
-                    if item['fields'][data_map['delete_by_field']] not in delete_list:
-                        delete_list.append(item['fields'][data_map['delete_by_field']])
-                create_list.append(model(**item['fields']))
-            if len(delete_list) > 0:
-                model.objects.filter(**{'%s__in' % data_map['delete_by_field']: delete_list}).delete()
-            model.objects.bulk_create(create_list)
+        self.run_stage('without_id', self.create_records_without_xml_id)
+        if self.fingerprints:
+            self.save_fingerprints(create_items, update_items)
+        transaction.on_commit(self.send_changes)
+        self.save_checkpoint('done')
 
+        if self.skipped:
+            log.info('skipped unchanged items: %s' % self.skipped)
+        self.summary.time = (datetime.now() - self.exec_time).total_seconds()
         log.info('exec time is: %s' % (datetime.now() - self.exec_time))
 
+    def run_stage(self, stage, func, *args):
+        """
+        Выполняет этап импорта, если он не был выполнен по контрольной точке ImportXML.checkpoint.
+        Этапы из ImportXML.chunked_stages сами фиксируют свои пачки, остальные выполняются в одной транзакции
+        """
+        if self.is_stage_done(stage):
+            log.info('skip %s stage..' % stage)
+            return
+        with self.measure(stage):
+            if stage in self.chunked_stages:
+                func(*args)
+                self.save_checkpoint(stage)
+            else:
+                with self.commit_chunk(stage):
+                    func(*args)
+
+    def save_checkpoint(self, stage, data_name=None, xml_id=None):
+        """
+        Сохраняет контрольную точку: этап и последнюю обработанную запись, если data_name не передан – этап выполнен.
+        Файл заменяется атомарно, чтобы прерванный импорт не оставил поврежденную контрольную точку
+        """
+        if not (self.commit_every and self.import_id):
+            return
+        checkpoint_path = self.get_checkpoint_path()
+        if not path.exists(path.dirname(checkpoint_path)):
+            makedirs(path.dirname(checkpoint_path))
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump({
+                'import_id': self.import_id,
+                'stage': stage,
+                'data_names': self.chunks_done if data_name else [],
+                'data_name': data_name,
+                'xml_id': xml_id}, f)
+        rename(checkpoint_path + '.tmp', checkpoint_path)
+
+    def save_key_index(self, versions):
+        """
+        Сохраняет индексы ImportXML.key_map в key_indexes после фиксации импорта. Снимок сохраняется, только
+        если версию индекса модели с момента загрузки увеличил лишь этот импорт, иначе прежний снимок удаляется
+
+        Args:
+            versions (dict): метка модели => версия индекса после сброса этим импортом, см. invalidate_key_indexes
+        """
+        for data_name, version in self.key_index_versions.items():
+            label = get_label(self.get_model(data_name))
+            if label in versions:
+                current, expected = versions[label], version + 1 if version is not None else None
+            else:
+                current, expected = get_key_index_version(label), version
+            if expected is not None and current == expected:
+                key_indexes[(label, self.id_field)] = (current, self.key_index_max[data_name], self.key_map[data_name])
+            else:
+                key_indexes.pop((label, self.id_field), None)
+
+    def save_fingerprints(self, *grouped_items):
+        """
+        Сохраняет отпечатки созданных и обновленных записей после фиксации транзакции импорта,
+        чтобы откат импорта не оставил отпечатки несохраненных данных
+        """
+        for items_dict in grouped_items:
+            for data_name, rows in items_dict.items():
+                handler = self.get_handler(data_name)
+                with self.files_index(data_name) as get_files:
+                    for batch in iter_batches(rows, self.memory_budget or len(rows) or 1):
+                        files = get_files([row[1] for row in batch])
+                        fingerprints = {
+                            row[1]: self.get_fingerprint(handler.unpack(row), files.get(row[1])) for row in batch}
+                        transaction.on_commit(partial(self.fingerprints.set_many, data_name, fingerprints))
+
+    def save_file(self, instance, model_property, file_name):
+        """
+        Копирует файл из ImportXML.open_file в хранилище поля без сохранения записи в БД
+
+        Returns:
+            bool: False, если содержимое файла совпадает с уже сохраненным и копирование пропущено
+        """
+        field_file = getattr(instance, model_property)
+        if field_file:
+            try:
+                with field_file.storage.open(field_file.name, 'rb') as stored:
+                    stored_hash = self.get_file_hash(stored)
+            except (IOError, OSError):
+                stored_hash = None
+            with self.open_file(file_name) as f:
+                if self.get_file_hash(f) == stored_hash:
+                    return False
+        with self.open_file(file_name) as f:
+            field_file.save(file_name, File(f), save=False)
+        return True
+
+    def save_files(self):
+        """
+        Сохраняет файлы из очереди ImportXML.files_lists: записи загружаются пачками через in_bulk,
+        файлы копируются в пуле из ImportXML.files_threads потоков, после чего имена новых файлов
+        записываются в БД через ImportXML.bulk_update (см. ImportXML.files_save_signals)
+        """
+        self.files_stats = {'saved': 0, 'skipped': 0}
+        pool = ThreadPool(self.files_threads)
+        try:
+            for data_name, files_list in self.iter_chunks('files', self.files_lists, itemgetter(0)):
+                model = self.get_model(data_name)
+                log.info('saving %s files..' % model.__name__)
+                with self.commit_chunk('files', data_name, files_list[-1][0]):
+                    self.save_files_chunk(pool, model, data_name, files_list)
+                log.info('saved %s files: %s' % (model.__name__, self.files_stats))
+        finally:
+            pool.close()
+            pool.join()
+
+    def save_files_chunk(self, pool, model, data_name, files_list):
+        """
+        Сохраняет файлы пачки записей одной модели
+
+        Args:
+            pool (ThreadPool): пул потоков для копирования файлов
+            model (django.db.models.Model): модель записей
+            data_name (str): ключ ImportXML.data_map
+            files_list (list): список пар (xml_id, {model_property: file_name})
+        """
+        site_ids = self.key_map[data_name]
+        instances = {}
+        pk_list = list({site_ids[xml_id] for xml_id, _ in files_list if xml_id in site_ids})
+        for batch in chunks(pk_list, self.update_batch_size):
+            instances.update(model.objects.in_bulk(batch))
+
+        tasks = OrderedDict()
+        for xml_id, item_files in files_list:
+            if site_ids.get(xml_id) not in instances:
+                raise model.DoesNotExist('%s with %s=%s does not exist' % (model.__name__, self.id_field, xml_id))
+            instance = instances[site_ids[xml_id]]
+            for model_property, file_name in item_files.items():
+                tasks[(instance.pk, model_property)] = (instance, model_property, file_name)
+
+        changed = OrderedDict()
+        results = pool.imap(lambda task: (task, self.save_file(*task)), tasks.values())
+        self.add_rows(len(tasks))
+        for done, ((instance, model_property, file_name), saved) in enumerate(results, 1):
+            if saved:
+                self.files_stats['saved'] += 1
+                changed.setdefault(instance, []).append(model_property)
+            else:
+                self.files_stats['skipped'] += 1
+            if done % 1000 == 0:
+                log.info('saving %s files: %i/%i' % (model.__name__, done, len(tasks)))
+
+        if self.files_save_signals:
+            for instance, fields in changed.items():
+                instance.save(update_fields=fields)
+        else:
+            self.bulk_update(model, [(instance.pk, {name: getattr(instance, name).name for name in fields})
+                                     for instance, fields in changed.items()])
+
+    def send_changes(self):
+        """
+        Сбрасывает версии индексов xml_id => id измененных моделей, при ImportXML.invalidate_cache – также версии
+        их кеша (см. cache_versions) и отправляет сигнал records_changed с множествами xml_id созданных,
+        обновленных и удаленных записей, затем сохраняет снимки индексов ImportXML.key_index. Изменения
+        до контрольной точки продолженного импорта неизвестны, поэтому в этом случае сбрасываются все модели
+        ImportXML.data_map
+        """
+        models = set(self.changed_models)
+        for keys in (self.created_keys, self.updated_keys, self.deleted_keys):
+            models.update(get_label(self.get_model(data_name)) for data_name in keys)
+        if self.checkpoint:
+            models.update(get_label(handler.model) for handler in self.handlers.values())
+        if self.invalidate_cache:
+            versions = invalidate_models(models)
+            records_changed.send(
+                sender=self.__class__, import_xml=self, models=models,
+                created={data_name: set(keys) for data_name, keys in self.created_keys.items()},
+                updated={data_name: set(keys) for data_name, keys in self.updated_keys.items()},
+                deleted={data_name: set(keys) for data_name, keys in self.deleted_keys.items()})
+        else:
+            versions = invalidate_key_indexes(models)
+        if self.key_index_versions:
+            self.save_key_index(versions)
+
+    @contextmanager
+    def staging_table(self, model, fields):
+        """
+        Создает временную таблицу с колонками fields модели и колонкой import_group, удаляя ее после блока.
+        Если блок прерван ошибкой, таблица остается до конца сессии и пересоздается следующим вызовом
+
+        Yields:
+            str: имя временной таблицы в кавычках
+        """
+        qn = connection.ops.quote_name
+        name = truncate_name('import_staging_%s' % model._meta.db_table, connection.ops.max_name_length())
+        id_column = model._meta.get_field(self.id_field).column
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % qn(name))
+            cursor.execute('CREATE TEMPORARY TABLE %s AS SELECT %s, 0 AS import_group FROM %s WHERE 1 = 0' % (
+                qn(name), ', '.join(qn(field.column) for field in fields), qn(model._meta.db_table)))
+            cursor.execute('CREATE INDEX %s ON %s (%s, import_group)' % (
+                qn(truncate_name(name + '_key', connection.ops.max_name_length())), qn(name), qn(id_column)))
+        yield qn(name)
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE %s' % qn(name))
+
+    def staging_create_records(self, create_items):
+        """
+        Создает новые записи через временную таблицу: пачка по ImportXML.commit_every загружается
+        в нее executemany со значениями, подготовленными как в bulk_create, и переносится в таблицу модели
+        одним INSERT ... SELECT для xml_id, которых в ней нет. Порядок data_name – ImportXML.create_order
+        """
+        qn = connection.ops.quote_name
+        create_items = OrderedDict(
+            (data_name, create_items[data_name]) for data_name in self.create_order if data_name in create_items)
+        for data_name, rows in self.iter_chunks('create', create_items):
+            handler = self.get_handler(data_name)
+            model = handler.model
+            fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+            id_column = qn(model._meta.get_field(self.id_field).column)
+            with self.commit_chunk('create', data_name, rows[-1][1]), self.staging_table(model, fields) as staging:
+                self.prefetch_keys(handler, rows)
+                values_list, keys_list = [], []
+                for item in map(handler.unpack, rows):
+                    self.localize_keys(item)
+                    keys_list.append(item['xml_id'])
+                    item['fields'][self.id_field] = item['xml_id']
+                    obj = model(**item['fields'])
+                    values_list.append(
+                        [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields] + [0])
+                self.append_keys(data_name, keys_list, self.created_keys)
+                log.info('create %s items..' % model.__name__)
+                columns = ', '.join(qn(field.column) for field in fields)
+                self.staging_load(staging, fields, values_list)
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'INSERT INTO %s (%s) SELECT %s FROM %s staging WHERE NOT EXISTS '
+                        '(SELECT 1 FROM %s target WHERE target.%s = staging.%s)' % (
+                            qn(model._meta.db_table), columns, columns, staging, qn(model._meta.db_table),
+                            id_column, id_column))
+                self.add_created_keys(data_name, model, [], keys_list)
+                self.add_rows(len(values_list))
+
+    def staging_delete(self, model, keys):
+        """Удаляет записи по xml_id одним DELETE через временную таблицу (только для моделей без связей и сигналов)"""
+        field = model._meta.get_field(self.id_field)
+        with self.staging_table(model, [field]) as staging:
+            self.staging_load(staging, [field], [[key, 0] for key in keys])
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM %s WHERE %s IN (SELECT %s FROM %s)' % (
+                    connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(field.column),
+                    connection.ops.quote_name(field.column), staging))
+                if cursor.rowcount:
+                    self.changed_models.add(get_label(model))
+
+    def staging_load(self, staging, fields, values_list):
+        """Загружает строки значений fields и import_group во временную таблицу пачками по update_batch_size"""
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s, import_group) VALUES (%s)' % (
+            staging, ', '.join(qn(field.column) for field in fields), ', '.join(['%s'] * (len(fields) + 1)))
+        with connection.cursor() as cursor:
+            for batch in chunks(values_list, self.update_batch_size):
+                cursor.executemany(sql, batch)
+
+    def staging_update_records(self, update_items):
+        """
+        Обновляет существующие записи через временную таблицу: записи пачки группируются по набору
+        изменяемых полей (import_group), каждая группа обновляется одним UPDATE из временной таблицы –
+        UPDATE ... FROM в PostgreSQL, коррелированными подзапросами в остальных БД. Из повторяющихся
+        в пачке xml_id применяется последняя запись
+        """
+        qn = connection.ops.quote_name
+        for data_name, rows in self.iter_chunks('update', update_items):
+            handler = self.get_handler(data_name)
+            model = handler.model
+            table = qn(model._meta.db_table)
+            fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+            index = {}
+            for i, field in enumerate(fields):
+                index[field.name] = index[field.attname] = i
+            id_index = index[self.id_field]
+            id_column = qn(fields[id_index].column)
+            log.info('update %s items..' % model.__name__)
+            with self.commit_chunk('update', data_name, rows[-1][1]), self.staging_table(model, fields) as staging:
+                self.prefetch_keys(handler, rows)
+                groups, values = OrderedDict(), OrderedDict()
+                for item in map(handler.unpack, rows):
+                    self.localize_keys(item)
+                    group = groups.setdefault(tuple(sorted(item['fields'])), len(groups))
+                    row = [None] * len(fields) + [group]
+                    row[id_index] = item['xml_id']
+                    for model_property, value in item['fields'].items():
+                        row[index[model_property]] = fields[index[model_property]].get_db_prep_save(value, connection)
+                    values[item['xml_id']] = row
+                self.staging_load(staging, fields, values.values())
+                with connection.cursor() as cursor:
+                    for field_names, group in groups.items():
+                        columns = [qn(fields[index[name]].column) for name in field_names]
+                        if not columns:
+                            continue
+                        if connection.vendor == 'postgresql':
+                            cursor.execute('UPDATE %s SET %s FROM %s staging WHERE staging.%s = %s.%s AND '
+                                           'staging.import_group = %%s' % (
+                                               table, ', '.join('%s = staging.%s' % (column, column) for column in columns),
+                                               staging, id_column, table, id_column), [group])
+                        else:
+                            cursor.execute('UPDATE %s SET %s WHERE %s IN (SELECT %s FROM %s WHERE import_group = %%s)' % (
+                                table, ', '.join(
+                                    '%s = (SELECT staging.%s FROM %s staging WHERE staging.%s = %s.%s AND '
+                                    'staging.import_group = %%s)' % (column, column, staging, id_column, table, id_column)
+                                    for column in columns), id_column, id_column, staging), [group] * (len(columns) + 1))
+                self.append_keys(data_name, list(values), self.updated_keys)
+                self.add_rows(len(values))
+
+    def skip_unchanged(self, update_items):
+        """
+        Убирает из update_items и ImportXML.files_lists записи, отпечаток которых совпадает
+        с сохраненным в ImportXML.fingerprints, количество пропущенных записей сохраняется в ImportXML.skipped
+        """
+        self.skipped = {}
+        for data_name, rows in update_items.items():
+            handler = self.get_handler(data_name)
+            changed, changed_ids, unchanged_ids = self.new_list(), set(), set()
+            with self.files_index(data_name) as get_files:
+                for batch in iter_batches(rows, self.memory_budget or len(rows) or 1):
+                    files = get_files([row[1] for row in batch])
+                    # внешние ключи на записи, которых нет в файле, загружаются до подсчета отпечатков,
+                    # иначе отпечаток не совпадет с сохраненным после импорта и запись не будет пропущена
+                    self.prefetch_keys(handler, batch)
+                    stored = self.fingerprints.get_many(data_name, [row[1] for row in batch])
+                    for row in batch:
+                        if stored.get(row[1]) != self.get_fingerprint(handler.unpack(row), files.get(row[1])):
+                            changed.append(row)
+                            changed_ids.add(row[1])
+                        else:
+                            unchanged_ids.add(row[1])
+            if len(changed) == len(rows):
+                continue
+            skipped_ids = unchanged_ids - changed_ids
+            if data_name in self.files_lists:
+                files_list = self.new_list()
+                for x in self.files_lists[data_name]:
+                    if x[0] not in skipped_ids:
+                        files_list.append(x)
+                self.files_lists[data_name] = files_list
+            update_items[data_name] = changed
+            self.skipped[data_name] = len(rows) - len(changed)
+
+    def update_records(self, update_items):
+        """Обновляет существующие записи пачками по ImportXML.commit_every"""
+        for data_name, rows in self.iter_chunks('update', update_items):
+            handler = self.get_handler(data_name)
+            model = handler.model
+            log.info('update %s items..' % model.__name__)
+            with self.commit_chunk('update', data_name, rows[-1][1]):
+                self.prefetch_keys(handler, rows)
+                items = map(handler.unpack, rows)
+                for item in items:
+                    self.localize_keys(item)
+                self.bulk_update(model, [(self.key_map[data_name][item['xml_id']], item['fields']) for item in items])
+                self.append_keys(data_name, [item['xml_id'] for item in items], self.updated_keys)
+                self.add_rows(len(items))
+
     def update_keys(self):
         """Обновляет ImportXML.key_map записями из очереди ImportXML.keys_get_lists"""
-        for data_name, keys in self.keys_get_lists.items():
-            model = self.get_model(data_name)
-            ids = {unicode(x[self.id_field]): x['id'] for x in model.objects.filter(
-                **{'%s__in' % self.id_field: keys}).values('id', self.id_field)}
-            self.key_map[data_name].update(ids)
-            self.keys_get_lists[data_name] = []
+        with self.measure('keys'):
+            for data_name, keys in self.keys_get_lists.items():
+                if data_name in self.key_index_max:
+                    self.keys_get_lists[data_name] = []
+                    continue
+                model = self.get_model(data_name)
+                ids = {self.intern_key(unicode(x[self.id_field])): x['id'] for x in model.objects.filter(
+                    **{'%s__in' % self.id_field: keys}).values('id', self.id_field)}
+                self.key_map[data_name].update(ids)
+                self.keys_get_lists[data_name] = []
+                self.add_rows(len(ids))
 
-    def update_item_data(self, xml, data_map, data):
+    def update_item_data(self, xml, block, data):
         """
         Обновляет data данными из XML элемента
 
         Args:
             xml (etree._Element): источник данных
-            data_map (dict): словарь со схемой данных
+            block (DataBlock): скомпилированная схема данных
             data (dict): результирующий словарь
 
         """
-        if 'attributes' in data_map:
-            for xml_key, model_property in data_map['attributes'].items():
-                if xml_key in xml.attrib:
-                    value = xml.attrib[xml_key]
-                    if 'clean_fields' in data_map and model_property in data_map['clean_fields']:
-                        func = data_map['clean_fields'][model_property]
-                        if isinstance(func, (str, unicode)):
-                            func = getattr(self, func)
-                        value = func(value)
-                    data['fields'][model_property] = value
+        attrib = xml.attrib
+        fields = data['fields']
+        for xml_key, model_property, func in block.attributes:
+            if xml_key in attrib:
+                fields[model_property] = func(attrib[xml_key]) if func else attrib[xml_key]
 
-        if 'text' in data_map and xml.text:
-            data['fields'][data_map['text']] = xml.text
+        if block.text and xml.text:
+            fields[block.text] = xml.text
 
-        if 'foreign_keys' in data_map:
-            for xml_key, (model_property, target_data_name) in data_map['foreign_keys'].items():
-                if xml_key in xml.attrib:
-                    # заполнить xml foreign_key, который потом заменить на id из бд сайта
-                    data['foreign_keys'][model_property] = (xml.attrib[xml_key], target_data_name)
+        for xml_key, model_property, target_data_name in block.foreign_keys:
+            if xml_key in attrib:
+                # заполнить xml foreign_key, который потом заменить на id из бд сайта
+                data['foreign_keys'][model_property] = (self.intern_key(attrib[xml_key]), target_data_name)
 
-        if 'files' in data_map:
+        if block.files:
             item_files = {}
-            for xml_key, model_property in data_map['files'].items():
-                if xml_key in xml.attrib:
-                    item_files[model_property] = xml.attrib[xml_key]
+            for xml_key, model_property in block.files:
+                if xml_key in attrib:
+                    item_files[model_property] = attrib[xml_key]
             if item_files:
                 self.append_keys(data['data_name'], (data['xml_id'], item_files), self.files_lists)
 
+    def update_unresolved_keys(self):
+        """Обновляет внешние ключи записей из ImportXML.unresolved_keys, ссылающиеся на только созданные объекты"""
+        for data_name, unresolved in self.unresolved_keys.items():
+            model = self.get_model(data_name)
+            site_ids = self.key_map[data_name]
+            update_list = []
+            for (model_property, target_data_name), (items_xml_id, targets_xml_id) in unresolved.items():
+                target_ids = self.key_map[target_data_name]
+                for item_xml_id, xml_id in izip(items_xml_id, targets_xml_id):
+                    try:
+                        field_val = target_ids[xml_id]
+                    except KeyError as e:
+                        if self.raise_unresolved_errors:
+                            raise e
+                        continue
+                    if item_xml_id in site_ids:
+                        update_list.append((site_ids[item_xml_id], {model_property: field_val}))
+            self.bulk_update(model, update_list)
+            self.add_rows(len(update_list))
+
+
+def make_work_dir():
+    """
+    Создает, если ее нет, и возвращает папку, в которой создаются рабочие папки импортов и загруженные архивы,
+    по умолчанию MEDIA_ROOT/import_zip
+    """
+    work_dir = getattr(settings, 'IMPORTXML_WORK_DIR', path.join(settings.MEDIA_ROOT, 'import_zip'))
+    try:
+        makedirs(work_dir)
+    except OSError:
+        # папку мог создать параллельный импорт
+        if not path.isdir(work_dir):
+            raise
+    return work_dir
+
+
+def import_zip(file_path, stream=False, import_id=None, commit_every=None, parse_processes=1, import_class=ImportXML):
+    """
+    Импортирует zip архив с xml файлами и файлами, на которые они ссылаются. Архив распаковывается
+    в отдельную рабочую папку, импорт выполняется под блокировкой моделей ImportXML.data_map
+    (см. locks.lock_models), поэтому импорты с разными наборами моделей могут идти параллельно
+
+    Args:
+        file_path (str): путь к архиву
+        stream (bool): разбирать xml потоково прямо из архива без распаковки, копируя в хранилище
+            только те файлы, на которые есть ссылки в xml
+        import_id (str): идентификатор импорта, по которому прерванный импорт продолжается с контрольной точки
+        commit_every (int): фиксировать транзакцию каждые N записей, см. ImportXML.commit_every
+        parse_processes (int): разбирать каждый xml файл в нескольких процессах, см. ImportXML.parse_processes
+        import_class (type): класс импорта, например подкласс ImportXML со своим data_map
+
+    Returns:
+        list: ImportSummary каждого xml файла архива
+    """
+    summaries = []
+    import_instance = import_class()
+    import_instance.commit_every = commit_every
+    import_instance.parse_processes = parse_processes
+    temp_dir = None
+    with lock_models(get_label(handler.model) for handler in import_instance.handlers.values()):
+        zf = zipfile.ZipFile(file_path, 'r')
+        try:
+            xml_names = [file_name for file_name in zf.namelist() if file_name.split('.')[-1] == 'xml']
+            if stream:
+                import_instance.files_zip = zf
+                import_instance.iterparse = True
+            else:
+                temp_dir = mkdtemp(dir=make_work_dir())
+                for file_name in zf.namelist():
+                    target_path = path.join(temp_dir, file_name)
+                    if file_name.endswith('/'):
+                        continue
+                    if not path.exists(path.dirname(target_path)):
+                        makedirs(path.dirname(target_path))
+                    with zf.open(file_name) as data, open(target_path, 'wb') as new_file:
+                        copyfileobj(data, new_file, 64 * 1024)
+                import_instance.files_dir = temp_dir
+
+            for file_name in xml_names:
+                if import_id:
+                    import_instance.import_id = '%s-%s' % (import_id, file_name.replace('/', '_'))
+                if stream:
+                    with zf.open(file_name) as f:
+                        summaries.append(import_instance.process_stream(f))
+                else:
+                    summaries.append(import_instance.process_file(path.join(temp_dir, file_name)))
+        finally:
+            zf.close()
+            if temp_dir:
+                rmtree(temp_dir, ignore_errors=True)
 
-def import_zip(file_path):
-    zf = zipfile.ZipFile(file_path, 'r')
-    temp_dir = path.join(settings.MEDIA_ROOT, 'import_zip')
-    if path.exists(temp_dir):
-        rmtree(temp_dir)
-    makedirs(temp_dir)
-    import_files = []
-    for file_name in zf.namelist():
-        data = zf.read(file_name)
-        temp_path = path.join(temp_dir, file_name)
-        new_file = open(temp_path, 'w+')
-        new_file.write(data)
-        new_file.close()
-        if file_name.split('.')[-1] == 'xml':
-            import_files.append(temp_path)
-    import_instance = ImportXML()
-    import_instance.files_dir = temp_dir
-    for f in import_files:
-        import_instance.process_file(f)
-    rmtree(temp_dir)
-    cache.clear()
+    # контрольные точки удаляются только после импорта всех файлов архива, кеш измененных моделей
+    # сбрасывается в ImportXML.send_changes, полная очистка кеша – по settings.IMPORTXML_CACHE_CLEAR
+    if import_id:
+        for file_name in xml_names:
+            import_instance.import_id = '%s-%s' % (import_id, file_name.replace('/', '_'))
+            import_instance.clear_checkpoint()
+    if getattr(settings, 'IMPORTXML_CACHE_CLEAR', False):
+        cache.clear()
+    return summaries
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.core.management import call_command
+from lxml import etree
+from datetime import datetime, timedelta
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+import random
+from . import FingerprintStore, ImportXML
+
+INTEGER_FIELDS = ('AutoField', 'BigIntegerField', 'IntegerField', 'PositiveIntegerField',
+                  'PositiveSmallIntegerField', 'SmallIntegerField')
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+
+class XMLGenerator(object):
+    """
+    Детерминированный генератор xml по схеме ImportXML.data_map. Дочерние элементы корня распределяются
+    по data_name верхнего уровня, data_name, на которые ссылаются внешние ключи (разделы), получают
+    долю reference_ratio. Значения атрибутов подбираются по типам полей моделей, внешние ключи ссылаются
+    на существующие xml_id, ревизии больше 0 меняют часть значений и помечают часть записей DoRemove
+    """
+    reference_ratio = 0.05
+    """float: доля элементов data_name, на которые ссылаются внешние ключи"""
+    children_count = 2
+    """int: количество дочерних элементов каждого дочернего data_name у элемента"""
+    change_ratio = 0.1
+    """float: доля записей, значения которых меняются в следующей ревизии"""
+    remove_ratio = 0.01
+    """float: доля записей, помечаемых DoRemove в следующей ревизии"""
+    files_dir = None
+    """str: папка файлов для атрибутов files, если не задана – атрибуты files не заполняются"""
+    files_count = 10
+
+    def __init__(self, import_xml, size, seed=0, revision=0, files_dir=None):
+        """
+        Args:
+            import_xml (ImportXML): импорт со скомпилированной схемой
+            size (int): количество дочерних элементов корня
+            seed (int): зерно генератора случайных чисел
+            revision (int): ревизия данных, 0 – первичная выгрузка
+            files_dir (str): папка, в которую пишутся файлы для атрибутов files
+        """
+        self.import_xml = import_xml
+        self.handlers = import_xml.handlers
+        self.size = size
+        self.seed = seed
+        self.revision = revision
+        self.files_dir = files_dir
+        self.counts = self.get_counts()
+
+    def get_counts(self):
+        """Возвращает количество элементов по data_name верхнего уровня"""
+        top = sorted(data_name for data_name in self.handlers if '.' not in data_name)
+        referenced = self.get_referenced()
+        if len(referenced) == len(top):
+            referenced = set()
+        counts = {data_name: max(1, int(self.size * self.reference_ratio)) for data_name in referenced}
+        rest = [data_name for data_name in top if data_name not in referenced]
+        left = max(len(rest), self.size - sum(counts.values()))
+        for i, data_name in enumerate(rest):
+            counts[data_name] = left // len(rest) + (1 if i < left % len(rest) else 0)
+        return counts
+
+    def get_referenced(self):
+        """Возвращает data_name верхнего уровня, на которые ссылаются внешние ключи других data_name"""
+        referenced = set()
+        for data_name, handler in self.handlers.items():
+            for block in [handler] + list(handler.children_fields.values()):
+                for xml_key, model_property, target_data_name in block.foreign_keys:
+                    if target_data_name != data_name and '.' not in target_data_name:
+                        referenced.add(target_data_name)
+        return referenced
+
+    def get_value(self, rnd, model, model_property, number):
+        """Возвращает строковое значение атрибута для поля модели"""
+        field = model._meta.get_field(model_property)
+        field_type = field.get_internal_type()
+        if field_type in INTEGER_FIELDS:
+            return '%i' % rnd.randint(0, 10000)
+        if field_type in ('DecimalField', 'FloatField'):
+            return '%.2f' % rnd.uniform(0, 10000)
+        if field_type == 'BooleanField':
+            return rnd.choice(('true', 'false'))
+        if field_type in ('DateTimeField', 'DateField'):
+            value = datetime(2017, 1, 1) + timedelta(seconds=rnd.randint(0, 10 ** 8))
+            return value.strftime('%Y-%m-%dT%H:%M:%S' if field_type == 'DateTimeField' else '%Y-%m-%d')
+        value = '%s %i %i' % (model_property, number, rnd.randint(0, 10 ** 6))
+        return value[:field.max_length] if field.max_length else value
+
+    def get_xml_id(self, data_name, number):
+        return '%s-%i' % (data_name.replace('.', '-'), number)
+
+    def fill_block(self, xml, handler, block, number, changed):
+        """
+        Заполняет атрибуты, текст, внешние ключи и файлы элемента по DataBlock. Значения зависят только
+        от номера записи и ее изменения в текущей ревизии, поэтому неизмененные записи совпадают с ревизией 0
+        """
+        rnd = random.Random('%s-%s-%s-%i-%i' % (self.seed, handler.data_name, xml.tag, number, changed))
+        for xml_key, model_property, func in block.attributes:
+            xml.set(xml_key, self.get_value(rnd, handler.model, model_property, number))
+        if block.text:
+            xml.text = self.get_value(rnd, handler.model, block.text, number)
+        for xml_key, model_property, target_data_name in block.foreign_keys:
+            if target_data_name == handler.data_name:
+                # ссылки на свой data_name только на предыдущие элементы, первый элемент – корень
+                target = rnd.randint(0, number - 1) if number else None
+            else:
+                target = rnd.randint(0, self.counts.get(target_data_name, 1) - 1)
+            xml.set(xml_key, self.get_xml_id(target_data_name, target) if target is not None else '')
+        if self.files_dir:
+            for xml_key, model_property in block.files:
+                xml.set(xml_key, 'file-%i.txt' % rnd.randint(0, self.files_count - 1))
+
+    def make_element(self, rnd, data_name, tag, number):
+        """Создает элемент data_name с дочерними элементами"""
+        handler = self.handlers[data_name]
+        xml = etree.Element(tag, {self.import_xml.id_xml_attr: self.get_xml_id(data_name, number)})
+        changed = self.revision if rnd.random() < self.change_ratio else 0
+        self.fill_block(xml, handler, handler, number, changed)
+        for child_tag, block in sorted(handler.children_fields.items()):
+            self.fill_block(etree.SubElement(xml, child_tag), handler, block, number, changed)
+        for child_tag, child in sorted(handler.children.items()):
+            for i in range(self.children_count):
+                xml.append(self.make_element(rnd, child.data_name, child_tag, number * self.children_count + i))
+        return xml
+
+    def write(self, file_path):
+        """
+        Записывает xml в файл потоково через etree.xmlfile
+
+        Returns:
+            int: количество дочерних элементов корня
+        """
+        if self.files_dir:
+            for i in range(self.files_count):
+                with open(path.join(self.files_dir, 'file-%i.txt' % i), 'wb') as f:
+                    f.write(b'%i' % i * 1024)
+        rnd = random.Random('%s-%i' % (self.seed, self.revision))
+        referenced = self.get_referenced()
+        written = 0
+        with etree.xmlfile(file_path, encoding='utf-8') as xf:
+            with xf.element('Root'):
+                for data_name in sorted(self.counts, key=lambda x: (x not in referenced, x)):
+                    for number in range(self.counts[data_name]):
+                        # удаляются только записи, на которые не ссылаются внешние ключи
+                        if self.revision and data_name not in referenced and rnd.random() < self.remove_ratio:
+                            xml = etree.Element(data_name, {
+                                self.import_xml.id_xml_attr: self.get_xml_id(data_name, number), 'DoRemove': 'true'})
+                        else:
+                            xml = self.make_element(rnd, data_name, data_name, number)
+                        xf.write(xml)
+                        written += 1
+        return written
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, seed=0, revisions=2, import_class=ImportXML, files=False, log=None):
+    """
+    Прогоняет импорт сгенерированного xml каждого размера. Импорты фиксируются как обычно, чтобы замерить и
+    обработчики transaction.on_commit (отпечатки, сброс кеша), а перед каждым размером БД очищается командой
+    flush, поэтому запускать только на тестовой БД. Ревизия 0 создает записи, следующие ревизии обновляют
+    и удаляют их. Каждый импорт сравнивается по ImportSummary, поэтому запросы считаются при включенном
+    ImportXML.count_queries
+
+    Args:
+        sizes (iterable): количества дочерних элементов корня
+        seed (int): зерно генератора
+        revisions (int): количество последовательных импортов каждого размера
+        import_class (type): класс импорта
+        files (bool): заполнять атрибуты files (файлы копируются в хранилище и не удаляются)
+        log (callable): функция вывода прогресса
+
+    Returns:
+        dict: размер => ревизия => метрики, см. get_result
+    """
+    results = {}
+    temp_dir = mkdtemp()
+    try:
+        for size in sizes:
+            results['%i' % size] = size_results = {}
+            call_command('flush', interactive=False, verbosity=0)
+            import_xml = import_class()
+            if import_xml.fingerprints:
+                # отпечатки каждого размера хранятся во временной папке, отдельно от отпечатков settings
+                import_xml.fingerprints = FingerprintStore(path.join(temp_dir, 'fingerprints-%i.sqlite3' % size))
+            for revision in range(revisions):
+                file_path = path.join(temp_dir, 'import-%i-%i.xml' % (size, revision))
+                generator = XMLGenerator(import_xml, size, seed, revision, temp_dir if files else None)
+                items = generator.write(file_path)
+                import_xml.files_dir = temp_dir
+                summary = import_xml.process_file(file_path)
+                size_results['%i' % revision] = result = get_result(items, summary)
+                if log:
+                    log('%i items, revision %i: %.0f items/s, %.2f queries/item, peak %.1f MB' % (
+                        size, revision, result['items_per_second'], result['queries_per_item'],
+                        result['peak_rss'] / 1048576.0))
+    finally:
+        rmtree(temp_dir)
+    return results
+
+
+def get_result(items, summary):
+    """Возвращает метрики прогона по ImportSummary: items/s, запросы на запись и пик памяти по этапам"""
+    queries = sum(metrics['queries'] for metrics in summary.stages.values())
+    return {
+        'items': items,
+        'time': summary.time,
+        'items_per_second': items / summary.time if summary.time else 0,
+        'queries_per_item': float(queries) / items if items else 0,
+        'peak_rss': max(metrics['peak_rss'] for metrics in summary.stages.values()),
+        'stages': summary.stages}
+
+
+def compare_results(results, baseline):
+    """
+    Сравнивает результаты с сохраненными базовыми
+
+    Returns:
+        list: строки (размер, ревизия, метрика, базовое значение, текущее значение, отношение)
+    """
+    rows = []
+    for size, size_results in sorted(results.items(), key=lambda x: int(x[0])):
+        for revision, result in sorted(size_results.items()):
+            base = baseline.get(size, {}).get(revision)
+            if not base:
+                continue
+            for key in ('items_per_second', 'queries_per_item', 'peak_rss'):
+                ratio = float(result[key]) / base[key] if base[key] else 0
+                rows.append((size, revision, key, base[key], result[key], ratio))
+            for stage, metrics in result['stages'].items():
+                if stage in base['stages']:
+                    base_time = base['stages'][stage]['time']
+                    rows.append((size, revision, '%s time' % stage, base_time, metrics['time'],
+                                 metrics['time'] / base_time if base_time else 0))
+    return rows
+
+
+def load_baseline(file_path):
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline(file_path, results):
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Версионированные пространства кеша моделей. Ключи, построенные через make_model_key, перестают читаться
+после invalidate_models, поэтому импорт сбрасывает только кеш затронутых моделей вместо cache.clear().
+Отдельные версии индексов xml_id => id (см. ImportXML.load_key_index) увеличиваются после каждого импорта,
+изменившего модель, и при invalidate_models: код, меняющий xml_id или удаляющий записи вне ImportXML,
+вызывает invalidate_models либо invalidate_key_indexes
+"""
+from __future__ import unicode_literals
+from django.core.cache import cache
+import time
+
+VERSION_KEY = 'xml_import:version:%s'
+KEY_INDEX_VERSION_KEY = 'xml_import:key_index_version:%s'
+
+
+def get_label(model):
+    """Возвращает метку модели app_label.ModelName, как в результатах QuerySet.delete()"""
+    return model if isinstance(model, basestring) else model._meta.label
+
+
+def new_version():
+    """Возвращает начальную версию, не совпадающую с версиями, вытесненными из кеша ранее"""
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    """Возвращает значение счетчика версии, создавая его при отсутствии"""
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def incr_version(key):
+    """Увеличивает счетчик версии и возвращает новое значение"""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = new_version()
+        cache.set(key, version, None)
+        return version
+
+
+def get_model_version(model):
+    """Возвращает текущую версию пространства кеша модели"""
+    return get_version(VERSION_KEY % get_label(model))
+
+
+def get_key_index_version(model):
+    """Возвращает текущую версию индекса xml_id => id модели, None – если бэкенд кеша не хранит значения"""
+    return get_version(KEY_INDEX_VERSION_KEY % get_label(model))
+
+
+def make_model_key(model, key):
+    """
+    Возвращает ключ кеша в пространстве модели
+
+    Args:
+        model (django.db.models.Model, str): модель либо ее метка app_label.ModelName
+        key (str): ключ внутри пространства
+
+    Returns:
+        str: ключ с текущей версией модели
+    """
+    return 'xml_import:%s:%s:%s' % (get_label(model), get_model_version(model), key)
+
+
+def invalidate_key_indexes(models):
+    """
+    Увеличивает версии индексов xml_id => id моделей, делая недействительными их снимки во всех процессах
+
+    Returns:
+        dict: метка модели => новая версия индекса
+    """
+    return {get_label(model): incr_version(KEY_INDEX_VERSION_KEY % get_label(model)) for model in models}
+
+
+def invalidate_models(models):
+    """
+    Увеличивает версии пространств кеша моделей, делая недействительными все их ключи, и версии их индексов
+
+    Returns:
+        dict: метка модели => новая версия индекса, см. invalidate_key_indexes
+    """
+    for model in models:
+        incr_version(VERSION_KEY % get_label(model))
+    return invalidate_key_indexes(models)
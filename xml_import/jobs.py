@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models import F
+from django.utils import timezone
+from os import getpid, kill, path, remove
+import errno
+import logging
+import socket
+import threading
+import traceback
+import zipfile
+from . import import_zip
+from .models import ImportJob
+from .signals import import_done, stage_done
+
+log = logging.getLogger(__name__)
+
+
+def get_jobs_dir():
+    """Возвращает папку архивов заданий, по умолчанию MEDIA_ROOT/import_jobs"""
+    return getattr(settings, 'IMPORTXML_JOBS_DIR', path.join(settings.MEDIA_ROOT, 'import_jobs'))
+
+
+def get_import_id(job):
+    """Возвращает import_id задания, по которому прерванное задание продолжается с контрольной точки"""
+    return 'job-%s' % job.pk
+
+
+def get_worker_id():
+    """Возвращает идентификатор текущего процесса воркера: имя хоста и pid"""
+    return '%s:%s' % (socket.gethostname(), getpid())
+
+
+def is_worker_alive(worker):
+    """
+    Проверяет, жив ли процесс воркера. Процессы других хостов проверить нельзя, они считаются живыми,
+    пока обновляют ImportJob.heartbeat
+    """
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def enqueue(file_path):
+    """Ставит архив в очередь импорта и возвращает ImportJob"""
+    return ImportJob.objects.create(file_path=file_path)
+
+
+def claim_next(worker=None):
+    """
+    Забирает первое задание из очереди. Статус меняется условным UPDATE, поэтому одно задание
+    не достанется нескольким воркерам и без SELECT FOR UPDATE, которого нет в SQLite
+
+    Args:
+        worker (str): идентификатор воркера, по умолчанию get_worker_id()
+
+    Returns:
+        ImportJob: задание либо None, если очередь пуста
+    """
+    worker = worker or get_worker_id()
+    while True:
+        job = ImportJob.objects.filter(status=ImportJob.QUEUED).first()
+        if job is None:
+            return None
+        now = timezone.now()
+        claimed = ImportJob.objects.filter(pk=job.pk, status=ImportJob.QUEUED).update(
+            status=ImportJob.RUNNING, started=now, heartbeat=now, worker=worker, stage='', rows=0, files_done=0,
+            error='')
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def recover_running():
+    """
+    Возвращает в очередь задания, оставшиеся выполняемыми после падения воркера: процесс воркера на этом
+    хосте завершен либо воркер не обновлял ImportJob.heartbeat дольше settings.IMPORTXML_JOBS_HEARTBEAT_TIMEOUT
+    секунд. Задания живых воркеров не трогаются
+
+    Returns:
+        int: количество возвращенных в очередь заданий
+    """
+    stale = timezone.now() - timedelta(seconds=getattr(settings, 'IMPORTXML_JOBS_HEARTBEAT_TIMEOUT', 600))
+    count = 0
+    for job in ImportJob.objects.filter(status=ImportJob.RUNNING):
+        if job.heartbeat and job.heartbeat >= stale and is_worker_alive(job.worker):
+            continue
+        # условный UPDATE: задание не возвращается, если воркер успел его завершить
+        count += ImportJob.objects.filter(pk=job.pk, status=ImportJob.RUNNING, worker=job.worker).update(
+            status=ImportJob.QUEUED, worker='')
+    return count
+
+
+def retry_failed(job_ids=None):
+    """
+    Возвращает в очередь задания с ошибкой, архив которых сохранился. Контрольные точки задания не удаляются
+    при ошибке, поэтому повторный запуск продолжает импорт с места, где он прервался
+
+    Args:
+        job_ids (list): id заданий, по умолчанию все задания с ошибкой
+
+    Returns:
+        int: количество возвращенных в очередь заданий
+    """
+    jobs = ImportJob.objects.filter(status=ImportJob.FAILED)
+    if job_ids is not None:
+        jobs = jobs.filter(pk__in=job_ids)
+    count = 0
+    for job in jobs:
+        if not path.exists(job.file_path):
+            log.warning('job %s archive %s is missing, not retried' % (job.pk, job.file_path))
+            continue
+        count += ImportJob.objects.filter(pk=job.pk, status=ImportJob.FAILED).update(
+            status=ImportJob.QUEUED, worker='', finished=None)
+    return count
+
+
+@contextmanager
+def heartbeat(job):
+    """
+    Обновляет ImportJob.heartbeat задания из отдельного потока каждые settings.IMPORTXML_JOBS_HEARTBEAT секунд,
+    пока выполняется блок, чтобы recover_running отличал выполняемое задание от брошенного
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(getattr(settings, 'IMPORTXML_JOBS_HEARTBEAT', 30)):
+                try:
+                    ImportJob.objects.filter(pk=job.pk, worker=job.worker).update(heartbeat=timezone.now())
+                except DatabaseError as e:
+                    # например, SQLite заблокирован транзакцией импорта, отклик обновится на следующем шаге
+                    log.warning('job %s heartbeat failed: %s' % (job.pk, e))
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job):
+    """
+    Выполняет задание через import_zip с промежуточной фиксацией (settings.IMPORTXML_JOBS_COMMIT_EVERY),
+    так что этап и количество записей, обновляемые по сигналам stage_done и import_done, видны
+    в ImportJob до окончания импорта, а прерванное задание продолжается с контрольной точки
+    """
+    import_id = get_import_id(job)
+
+    def is_job_import(import_xml):
+        return bool(import_xml.import_id) and import_xml.import_id.startswith(import_id + '-')
+
+    def update_stage(sender, import_xml, stage, metrics, **kwargs):
+        if is_job_import(import_xml):
+            ImportJob.objects.filter(pk=job.pk).update(stage=stage, rows=F('rows') + metrics['rows'])
+
+    def update_files(sender, import_xml, **kwargs):
+        if is_job_import(import_xml):
+            ImportJob.objects.filter(pk=job.pk).update(files_done=F('files_done') + 1)
+
+    stage_done.connect(update_stage)
+    import_done.connect(update_files)
+    try:
+        with zipfile.ZipFile(job.file_path, 'r') as zf:
+            files_total = len([file_name for file_name in zf.namelist() if file_name.split('.')[-1] == 'xml'])
+        ImportJob.objects.filter(pk=job.pk).update(files_total=files_total)
+        with heartbeat(job):
+            import_zip(job.file_path, import_id=import_id,
+                       commit_every=getattr(settings, 'IMPORTXML_JOBS_COMMIT_EVERY', 1000))
+    except Exception:
+        error = traceback.format_exc()
+        log.error(error)
+        ImportJob.objects.filter(pk=job.pk, worker=job.worker).update(
+            status=ImportJob.FAILED, error=error, finished=timezone.now())
+    else:
+        ImportJob.objects.filter(pk=job.pk, worker=job.worker).update(
+            status=ImportJob.DONE, stage='done', finished=timezone.now())
+        if path.exists(job.file_path):
+            remove(job.file_path)
+    finally:
+        stage_done.disconnect(update_stage)
+        import_done.disconnect(update_files)
+    job.refresh_from_db()
+    return job
+
+
+def run_pending():
+    """Выполняет задания из очереди, пока она не опустеет, и возвращает количество выполненных заданий"""
+    count = 0
+    job = claim_next()
+    while job:
+        run_job(job)
+        count += 1
+        job = claim_next()
+    return count
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Межпроцессные блокировки моделей импорта на одном сервере. Каждой модели соответствует файл блокировки,
+импорты с пересекающимися наборами моделей выполняются по очереди, с непересекающимися – параллельно
+"""
+from __future__ import unicode_literals
+from django.conf import settings
+from contextlib import contextmanager
+from os import path, makedirs
+import fcntl
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def get_locks_dir():
+    """Возвращает папку файлов блокировок, по умолчанию MEDIA_ROOT/import_locks"""
+    return getattr(settings, 'IMPORTXML_LOCKS_DIR', path.join(settings.MEDIA_ROOT, 'import_locks'))
+
+
+@contextmanager
+def lock_models(labels):
+    """
+    Блокирует модели на время выполнения блока. Файлы блокируются в порядке сортировки меток,
+    поэтому импорты с пересекающимися наборами моделей не блокируют друг друга взаимно
+
+    Args:
+        labels (iterable): метки моделей app_label.ModelName
+    """
+    locks_dir = get_locks_dir()
+    if not path.exists(locks_dir):
+        try:
+            makedirs(locks_dir)
+        except OSError:
+            # папку мог создать параллельный импорт
+            if not path.isdir(locks_dir):
+                raise
+    files = []
+    try:
+        for label in sorted(set(labels)):
+            f = open(path.join(locks_dir, '%s.lock' % label), 'a')
+            files.append(f)
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                log.info('waiting for %s lock..' % label)
+                fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+    finally:
+        for f in reversed(files):
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from collections import OrderedDict
+from django.db import DEFAULT_DB_ALIAS, connections
+import resource
+
+
+def get_rss():
+    """Возвращает текущий размер резидентной памяти процесса в байтах"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_peak_rss():
+    """Возвращает пиковый размер резидентной памяти процесса в байтах с момента reset_peak_rss"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Сбрасывает пиковый размер памяти процесса (Linux 4.0+), чтобы измерить пик отдельного этапа"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+class CountingCursor(object):
+    """
+    Обертка над курсором соединения, считающая выполненные запросы. В отличие от отладочного курсора
+    не форматирует и не хранит текст запросов
+    """
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def callproc(self, procname, params=None):
+        self.counter.count += 1
+        return self.cursor.callproc(procname, params)
+
+
+class QueryCounter(object):
+    """
+    Считает запросы к БД через соединение по умолчанию. В Django 1.x нет connection.execute_wrapper,
+    поэтому на время подсчета курсоры соединения оборачиваются в CountingCursor
+    """
+    count = 0
+    connection = None
+    saved = None
+
+    def __enter__(self):
+        self.connection = connections[DEFAULT_DB_ALIAS]
+        # обертки вложенных счетчиков сохраняются, чтобы восстановить их при выходе
+        self.saved = {}
+        for name in ('make_cursor', 'make_debug_cursor'):
+            self.saved[name] = self.connection.__dict__.get(name)
+            setattr(self.connection, name, self.wrap(getattr(self.connection, name)))
+        return self
+
+    def __exit__(self, *args):
+        for name, method in self.saved.items():
+            if method is None:
+                delattr(self.connection, name)
+            else:
+                setattr(self.connection, name, method)
+
+    def wrap(self, make_cursor):
+        def wrapper(cursor):
+            return CountingCursor(make_cursor(cursor), self)
+        return wrapper
+
+
+class ImportSummary(object):
+    """Итоги импорта: метрики этапов в порядке выполнения, пропущенные записи и счетчики файлов"""
+    stages = None
+    """OrderedDict: этап => {time, rows, queries, rss, peak_rss, error}"""
+    skipped = None
+    """dict: data_name => количество неизмененных записей"""
+    files = None
+    """dict: счетчики сохраненных и пропущенных файлов"""
+    time = None
+    """float: общее время импорта в секундах"""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.skipped = {}
+        self.files = {}
+
+    def __str__(self):
+        return '; '.join('%s: %.2fs, %i rows, %i queries, peak %.1f MB' % (
+            stage, metrics['time'], metrics['rows'], metrics['queries'], metrics['peak_rss'] / 1048576.0)
+            for stage, metrics in self.stages.items())
+
+    def add(self, stage, metrics):
+        """Добавляет метрики этапа, суммируя их с уже добавленными метриками этого же этапа"""
+        if stage not in self.stages:
+            self.stages[stage] = dict(metrics)
+            return
+        total = self.stages[stage]
+        for key in ('time', 'rows', 'queries'):
+            total[key] += metrics[key]
+        total['rss'] = metrics['rss']
+        total['error'] = total.get('error', False) or metrics.get('error', False)
+        total['peak_rss'] = max(total['peak_rss'], metrics['peak_rss'])
+
+    def as_dict(self):
+        return {'stages': self.stages, 'skipped': self.skipped, 'files': self.files, 'time': self.time}
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', '\u0432 \u043e\u0447\u0435\u0440\u0435\u0434\u0438'), ('running', '\u0432\u044b\u043f\u043e\u043b\u043d\u044f\u0435\u0442\u0441\u044f'), ('done', '\u0432\u044b\u043f\u043e\u043b\u043d\u0435\u043d\u043e'), ('failed', '\u043e\u0448\u0438\u0431\u043a\u0430')], db_index=True, default='queued', max_length=10, verbose_name='\u0441\u0442\u0430\u0442\u0443\u0441')),
+                ('file_path', models.CharField(max_length=255, verbose_name='\u0430\u0440\u0445\u0438\u0432')),
+                ('files_done', models.PositiveIntegerField(default=0, verbose_name='\u043e\u0431\u0440\u0430\u0431\u043e\u0442\u0430\u043d\u043e xml \u0444\u0430\u0439\u043b\u043e\u0432')),
+                ('files_total', models.PositiveIntegerField(default=0, verbose_name='\u0432\u0441\u0435\u0433\u043e xml \u0444\u0430\u0439\u043b\u043e\u0432')),
+                ('stage', models.CharField(blank=True, max_length=20, verbose_name='\u044d\u0442\u0430\u043f')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='\u043e\u0431\u0440\u0430\u0431\u043e\u0442\u0430\u043d\u043e \u0437\u0430\u043f\u0438\u0441\u0435\u0439')),
+                ('error', models.TextField(blank=True, verbose_name='\u043e\u0448\u0438\u0431\u043a\u0430')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='\u0441\u043e\u0437\u0434\u0430\u043d\u043e')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='\u0437\u0430\u043f\u0443\u0449\u0435\u043d\u043e')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='\u0437\u0430\u0432\u0435\u0440\u0448\u0435\u043d\u043e')),
+                ('worker', models.CharField(blank=True, max_length=100, verbose_name='\u0432\u043e\u0440\u043a\u0435\u0440')),
+                ('heartbeat', models.DateTimeField(blank=True, null=True, verbose_name='\u043f\u043e\u0441\u043b\u0435\u0434\u043d\u0438\u0439 \u043e\u0442\u043a\u043b\u0438\u043a \u0432\u043e\u0440\u043a\u0435\u0440\u0430')),
+            ],
+            options={
+                'ordering': ('id',),
+                'verbose_name': '\u0437\u0430\u0434\u0430\u043d\u0438\u0435 \u0438\u043c\u043f\u043e\u0440\u0442\u0430',
+                'verbose_name_plural': '\u0437\u0430\u0434\u0430\u043d\u0438\u044f \u0438\u043c\u043f\u043e\u0440\u0442\u0430',
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.db import models
+
+
+class ImportJob(models.Model):
+    """Задание очереди импорта zip архива, выполняемое командой xml_import_worker"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'в очереди'),
+        (RUNNING, 'выполняется'),
+        (DONE, 'выполнено'),
+        (FAILED, 'ошибка'),
+    )
+
+    status = models.CharField('статус', max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    file_path = models.CharField('архив', max_length=255)
+    files_done = models.PositiveIntegerField('обработано xml файлов', default=0)
+    files_total = models.PositiveIntegerField('всего xml файлов', default=0)
+    stage = models.CharField('этап', max_length=20, blank=True)
+    rows = models.PositiveIntegerField('обработано записей', default=0)
+    error = models.TextField('ошибка', blank=True)
+    created = models.DateTimeField('создано', auto_now_add=True)
+    started = models.DateTimeField('запущено', null=True, blank=True)
+    finished = models.DateTimeField('завершено', null=True, blank=True)
+    worker = models.CharField('воркер', max_length=100, blank=True)
+    heartbeat = models.DateTimeField('последний отклик воркера', null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+        verbose_name = 'задание импорта'
+        verbose_name_plural = 'задания импорта'
+
+    def __unicode__(self):
+        return '%s %s' % (self.pk, self.status)
+
+    def as_dict(self):
+        """Возвращает состояние задания для ответа views.job_status"""
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'files_done': self.files_done,
+            'files_total': self.files_total,
+            'stage': self.stage,
+            'rows': self.rows,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'worker': self.worker,
+            'heartbeat': self.heartbeat,
+        }
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+stage_done = Signal(providing_args=['import_xml', 'stage', 'metrics'])
+"""Отправляется после каждого этапа ImportXML с метриками этапа"""
+
+import_done = Signal(providing_args=['import_xml', 'summary'])
+"""Отправляется после обработки файла ImportXML с итогами импорта"""
+
+records_changed = Signal(providing_args=['import_xml', 'models', 'created', 'updated', 'deleted'])
+"""
+Отправляется после фиксации импорта: models – метки измененных моделей, created / updated / deleted –
+множества xml_id по data_name для точечного сброса кеша
+"""
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Списки записей импорта с бюджетом памяти. Пока количество записей, накопленных в памяти всеми списками
+Spooler, не превышает бюджет, записи хранятся в обычных списках, при превышении списки сбрасываются
+сегментами во временные файлы и при переборе читаются из них потоково, сегмент за сегментом
+"""
+from __future__ import unicode_literals
+from itertools import islice
+from os import close, remove
+from tempfile import TemporaryFile, mkstemp
+from weakref import WeakSet
+import cPickle as pickle
+import sqlite3
+
+
+def iter_batches(items, size):
+    """Перебирает любую последовательность пачками-списками по size элементов, не загружая ее целиком"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+class RecordSpool(object):
+    """
+    Список записей, сбрасываемый во временный файл по команде Spooler. Поддерживает append, +=, len и
+    повторный перебор в порядке добавления, в том числе во время добавления записей в другие списки
+    """
+
+    def __init__(self, spooler):
+        self.spooler = spooler
+        self.buffer = []
+        self.file = None
+        self.spilled = 0
+
+    def __iadd__(self, rows):
+        self.buffer += rows
+        self.spooler.add(len(rows))
+        return self
+
+    def __iter__(self):
+        # сброс во время перебора пишет в конец файла и заменяет buffer новым списком, поэтому перебор
+        # дочитывает сегменты до своей позиции и затем перебирает буфер, взятый в момент начала
+        buffer, end, position = self.buffer, 0, 0
+        if self.file:
+            self.file.seek(0, 2)
+            end = self.file.tell()
+        while position < end:
+            self.file.seek(position)
+            segment = pickle.load(self.file)
+            position = self.file.tell()
+            for row in segment:
+                yield row
+        for row in buffer:
+            yield row
+
+    def __len__(self):
+        return self.spilled + len(self.buffer)
+
+    def append(self, row):
+        self.buffer.append(row)
+        self.spooler.add(1)
+
+    def spill(self):
+        """Дописывает записи из памяти сегментом в конец временного файла"""
+        if not self.buffer:
+            return
+        if self.file is None:
+            self.file = TemporaryFile(dir=self.spooler.temp_dir)
+        self.file.seek(0, 2)
+        pickle.dump(self.buffer, self.file, pickle.HIGHEST_PROTOCOL)
+        self.spilled += len(self.buffer)
+        self.buffer = []
+
+
+class Spooler(object):
+    """Бюджет памяти списков записей RecordSpool: при превышении budget записей в памяти сбрасываются все списки"""
+
+    def __init__(self, budget, temp_dir=None):
+        """
+        Args:
+            budget (int): максимальное количество записей в памяти всех списков
+            temp_dir (str): папка временных файлов, по умолчанию системная
+        """
+        self.budget = budget
+        self.temp_dir = temp_dir
+        self.rows = 0
+        self.spools = WeakSet()
+        self.spills = 0
+
+    def add(self, count):
+        self.rows += count
+        if self.rows > self.budget:
+            for spool in self.spools:
+                spool.spill()
+            self.rows = 0
+            self.spills += 1
+
+    def new(self):
+        """Возвращает новый пустой список записей"""
+        spool = RecordSpool(self)
+        self.spools.add(spool)
+        return spool
+
+
+class SpoolIndex(object):
+    """
+    Индекс пар (key, value) списка записей во временной sqlite базе: строится за один проход по списку,
+    после чего значения пачки ключей находятся без загрузки списка в память. Повторяющийся ключ получает
+    последнее значение, как в dict(items)
+    """
+    batch_size = 500
+
+    def __init__(self, items, temp_dir=None):
+        """
+        Args:
+            items (iterable): пары (key, value), value сериализуется через pickle
+            temp_dir (str): папка временного файла базы, по умолчанию системная
+        """
+        fd, self.file_path = mkstemp(suffix='.sqlite3', dir=temp_dir)
+        close(fd)
+        self.db = sqlite3.connect(self.file_path)
+        with self.db:
+            self.db.execute('CREATE TABLE item (key TEXT PRIMARY KEY, value BLOB)')
+            self.db.executemany('INSERT OR REPLACE INTO item VALUES (?, ?)', (
+                (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))) for key, value in items))
+
+    def close(self):
+        """Закрывает базу и удаляет ее файл"""
+        self.db.close()
+        remove(self.file_path)
+
+    def get_many(self, keys):
+        """Возвращает словарь key => value для найденных ключей"""
+        result = {}
+        for batch in iter_batches(keys, self.batch_size):
+            rows = self.db.execute('SELECT key, value FROM item WHERE key IN (%s)' % ', '.join('?' * len(batch)), batch)
+            result.update((key, pickle.loads(str(value))) for key, value in rows)
+        return result
@@ -0,0 +1,8 @@
+from django.conf.urls import url
+from . import views
+
+
+urlpatterns = [
+    url(r'^$', views.import_zip, name='import_zip'),
+    url(r'^jobs/(?P<job_id>\d+)/$', views.job_status, name='job_status'),
+]
@@ -1,33 +1,88 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+from django.apps import apps
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
-from os import path
-from . import import_zip
+from os import close, makedirs, path, remove
+from tempfile import mkstemp
+from . import import_zip as process_zip, make_work_dir
 import logging
 
 log = logging.getLogger(__name__)
 
 
+def check_api_key(request):
+    return request.META.get('HTTP_APIKEY') == settings.IMPORTXML_API_KEY
+
+
+def use_background_jobs():
+    """
+    Возвращает settings.IMPORTXML_BACKGROUND_JOBS, по умолчанию – добавлен ли xml_import в INSTALLED_APPS:
+    без этого нет модели задания, и архив импортируется сразу
+    """
+    app_name = __name__.rpartition('.')[0]
+    installed = apps.is_installed(app_name)
+    background = getattr(settings, 'IMPORTXML_BACKGROUND_JOBS', installed)
+    if background and not installed:
+        raise ImproperlyConfigured('IMPORTXML_BACKGROUND_JOBS требует %s в INSTALLED_APPS' % app_name)
+    return background
+
+
+def save_upload(request, archive_path):
+    """Записывает тело запроса в файл по частям"""
+    with open(archive_path, 'wb') as f:
+        while True:
+            data = request.read(64 * 1024)
+            if not data:
+                break
+            f.write(data)
+
+
 @csrf_exempt
 def import_zip(request):
-    if request.META.get('HTTP_APIKEY') != settings.IMPORTXML_API_KEY:
+    """
+    Принимает zip архив в теле запроса и ставит его в очередь импорта, возвращая id задания,
+    либо импортирует его сразу, если фоновые задания отключены, см. use_background_jobs
+    """
+    if not check_api_key(request):
         return HttpResponseBadRequest(u'ApiKey error')
 
-    archive_path = path.join(settings.MEDIA_ROOT, 'import.zip')
-    f = open(archive_path, 'wb')
-    while True:
-        data = request.read(64 * 1024)
-        f.write(data)
-        if not data:
-            break
-    f.close()
+    if use_background_jobs():
+        # модель задания импортируется, только если xml_import добавлен в INSTALLED_APPS
+        from .jobs import enqueue, get_jobs_dir
+        jobs_dir = get_jobs_dir()
+        if not path.exists(jobs_dir):
+            makedirs(jobs_dir)
+        fd, archive_path = mkstemp(suffix='.zip', dir=jobs_dir)
+        close(fd)
+        save_upload(request, archive_path)
+        job = enqueue(archive_path)
+        return JsonResponse({'job_id': job.pk}, status=202)
+
+    # у каждой загрузки свой архив, чтобы параллельная загрузка не перезаписала его во время импорта
+    fd, archive_path = mkstemp(suffix='.zip', dir=make_work_dir())
+    close(fd)
     try:
-        import_zip(archive_path)
+        save_upload(request, archive_path)
+        process_zip(archive_path)
     except Exception as e:
         import traceback
         tr = unicode(traceback.format_exc())
         log.error(tr)
         return HttpResponseBadRequest(tr)
+    finally:
+        remove(archive_path)
     return HttpResponse()
+
+
+def job_status(request, job_id):
+    """Возвращает статус задания импорта: этап, количество обработанных файлов и записей, ошибку"""
+    if not check_api_key(request):
+        return HttpResponseBadRequest(u'ApiKey error')
+    from .models import ImportJob
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return JsonResponse(job.as_dict(), encoder=DjangoJSONEncoder)